@@ -0,0 +1,58 @@
+# -*- coding: utf8 -*-
+#
+# ***** BEGIN GPL LICENSE BLOCK *****
+#
+# --------------------------------------------------------------------------
+# Blender Mitsuba Add-On
+# --------------------------------------------------------------------------
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+#
+# ***** END GPL LICENSE BLOCK *****
+
+
+'''
+Headless benchmarks of the mesh writers.
+
+The writer modules of mtsblend.outputs are imported without the addon,
+which needs Blender, and fed with fake meshes. Run from the repository
+root with:
+
+    python -m benchmarks --help
+'''
+
+import os
+import sys
+import types
+import importlib
+
+OUTPUTS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'mtsblend', 'outputs')
+OUTPUTS_PACKAGE = 'mtsblend_outputs'
+
+
+def outputs_module(name):
+    '''
+    name                module name in mtsblend.outputs
+
+    Import a writer module, skipping the bpy dependent package __init__.
+
+    Returns module
+    '''
+
+    if OUTPUTS_PACKAGE not in sys.modules:
+        package = types.ModuleType(OUTPUTS_PACKAGE)
+        package.__path__ = [OUTPUTS_PATH]
+        sys.modules[OUTPUTS_PACKAGE] = package
+
+    return importlib.import_module('%s.%s' % (OUTPUTS_PACKAGE, name))
@@ -0,0 +1,100 @@
+# -*- coding: utf8 -*-
+#
+# ***** BEGIN GPL LICENSE BLOCK *****
+#
+# --------------------------------------------------------------------------
+# Blender Mitsuba Add-On
+# --------------------------------------------------------------------------
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+#
+# ***** END GPL LICENSE BLOCK *****
+
+
+import sys
+import json
+import argparse
+
+from collections import OrderedDict
+
+from .fixtures import FIXTURES, make_fixture
+from .runner import WRITERS, option_sets, run_case, case_key, environment
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Benchmark the mtsblend mesh writers on synthetic meshes.')
+    parser.add_argument('--faces', type=int, nargs='+', default=[10000, 100000], help='mesh sizes, in faces')
+    parser.add_argument('--fixtures', nargs='+', default=sorted(FIXTURES.keys()), choices=sorted(FIXTURES.keys()), help='mesh presets to run')
+    parser.add_argument('--writers', nargs='+', default=list(WRITERS.keys()), choices=list(WRITERS.keys()), help='writers to run')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per case, the fastest is kept')
+    parser.add_argument('--output', default='mesh_benchmark.json', help='JSON file receiving the results')
+    parser.add_argument('--compare', help='JSON file of a previous run to compare against')
+
+    return parser.parse_args(argv)
+
+
+def format_result(result, baseline=None):
+    line = '%-10s %8d %-20s %-52s %8.3fs %12.0f tri/s %10d B %10.1f MB' % (
+        result['fixture'],
+        result['faces'],
+        result['writer'],
+        ' '.join('%s=%s' % item for item in result['options'].items()),
+        result['seconds'],
+        result['triangles_per_second'] or 0.0,
+        result['bytes'],
+        result['peak_memory'] / (1024.0 * 1024.0),
+    )
+
+    if baseline is not None and result['seconds'] > 0:
+        line += '  %5.2fx' % (baseline['seconds'] / result['seconds'])
+
+    return line
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    baselines = {}
+
+    if args.compare:
+        with open(args.compare, 'r') as compare_file:
+            for result in json.load(compare_file)['results']:
+                baselines[case_key(result)] = result
+
+    results = []
+
+    for fixture in args.fixtures:
+        for faces in args.faces:
+            mesh = make_fixture(fixture, faces)
+
+            for writer in args.writers:
+                for options in option_sets(WRITERS[writer][2]):
+                    result = run_case(mesh, writer, options, args.repeat)
+                    result['fixture'] = fixture
+                    result.move_to_end('fixture', last=False)
+                    results.append(result)
+
+                    print(format_result(result, baselines.get(case_key(result))))
+                    sys.stdout.flush()
+
+            del mesh
+
+    with open(args.output, 'w') as output_file:
+        json.dump(OrderedDict([('environment', environment()), ('results', results)]), output_file, indent=2)
+
+    print('Results written to %s' % args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+# -*- coding: utf8 -*-
+#
+# ***** BEGIN GPL LICENSE BLOCK *****
+#
+# --------------------------------------------------------------------------
+# Blender Mitsuba Add-On
+# --------------------------------------------------------------------------
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+#
+# ***** END GPL LICENSE BLOCK *****
+
+
+import types
+import math
+
+import numpy
+
+
+class FakeCollection(list):
+    '''
+    List of fake Blender data items, with bulk access to their attributes
+    through foreach_get like a bpy_prop_collection
+    '''
+
+    def __init__(self, items=(), arrays=None, active=None):
+        super().__init__(items)
+        self.arrays = arrays if arrays is not None else {}
+        self.active = active
+
+    def foreach_get(self, attr, seq):
+        seq[:] = self.arrays[attr].ravel()
+
+
+class FakeVertex:
+    __slots__ = ('co', 'normal')
+
+    def __init__(self, co, normal):
+        self.co = co
+        self.normal = normal
+
+
+class FakeFace:
+    __slots__ = ('index', 'vertices', 'use_smooth', 'normal', 'material_index')
+
+    def __init__(self, index, vertices, use_smooth, normal, material_index):
+        self.index = index
+        self.vertices = vertices
+        self.use_smooth = use_smooth
+        self.normal = normal
+        self.material_index = material_index
+
+
+class FakeUVFace:
+    __slots__ = ('uv',)
+
+    def __init__(self, uv):
+        self.uv = uv
+
+
+class FakeColorFace:
+    __slots__ = ('color1', 'color2', 'color3', 'color4')
+
+    def __init__(self, colors):
+        self.color1, self.color2, self.color3, self.color4 = colors
+
+
+class FakeMesh:
+    '''
+    Stand-in for a bpy.types.Mesh with tessfaces, holding the attributes
+    read by the mesh writers. Values are float32, as in Blender.
+    '''
+
+    def __init__(self, name, co, normals, faces, smooth, face_normals, materials, uv=None, colors=None):
+        # uv is (faces, 4, 2), colors (faces, 4, 3)
+        self.name = name
+        self.materials = [None] * (int(materials.max()) + 1 if len(materials) else 1)
+        self.show_double_sided = False
+
+        self.vertices = FakeCollection(
+            [FakeVertex(tuple(c), tuple(n)) for c, n in zip(co.tolist(), normals.tolist())],
+            {'co': co, 'normal': normals}
+        )
+
+        face_list = []
+
+        for i, (fv, s, n, m) in enumerate(zip(faces.tolist(), smooth.tolist(), face_normals.tolist(), materials.tolist())):
+            # triangles have 0 as their fourth vertex index
+            fv = fv if fv[3] != 0 else fv[:3]
+            face_list.append(FakeFace(i, fv, s, tuple(n), m))
+
+        self.tessfaces = FakeCollection(face_list, {
+            'vertices_raw': faces,
+            'use_smooth': smooth,
+            'normal': face_normals,
+            'material_index': materials,
+        })
+
+        self.uv_textures = types.SimpleNamespace(active=uv is not None)
+        self.tessface_uv_textures = FakeCollection()
+
+        if uv is not None:
+            data = FakeCollection([FakeUVFace([tuple(c) for c in f]) for f in uv.tolist()], {'uv_raw': uv})
+            layer = types.SimpleNamespace(data=data)
+            self.tessface_uv_textures = FakeCollection([layer], active=layer)
+
+        self.tessface_vertex_colors = FakeCollection()
+
+        if colors is not None:
+            data = FakeCollection(
+                [FakeColorFace([tuple(c) for c in f]) for f in colors.tolist()],
+                {'color%d' % (j + 1): colors[:, j] for j in range(4)}
+            )
+            layer = types.SimpleNamespace(data=data)
+            self.tessface_vertex_colors = FakeCollection([layer], active=layer)
+
+    @property
+    def triangle_count(self):
+        return int(len(self.tessfaces) + numpy.count_nonzero(self.tessfaces.arrays['vertices_raw'][:, 3]))
+
+
+def grid_mesh(faces, smooth=1.0, uv='none', colors=False, materials=1, triangles=False, seed=0):
+    '''
+    faces               approximate number of faces
+    smooth              fraction of smooth faces
+    uv                  'none', 'seamless' (one UV per vertex) or 'faces' (seams everywhere)
+    colors              bool, add a vertex color layer
+    materials           number of material indices, assigned in bands
+    triangles           bool, split every quad into two triangles
+    seed                random seed of the shading and colors
+
+    Build a wavy rectangular grid, similar to a subdivided surface.
+
+    Returns FakeMesh
+    '''
+
+    rng = numpy.random.RandomState(seed)
+    cells = faces // 2 if triangles else faces
+    nx = max(int(math.sqrt(cells)), 1)
+    ny = max(cells // nx, 1)
+
+    x, y = numpy.meshgrid(numpy.linspace(-1.0, 1.0, nx + 1), numpy.linspace(-1.0, 1.0, ny + 1))
+    z = 0.1 * numpy.sin(4.0 * x) * numpy.cos(4.0 * y)
+    co = numpy.column_stack((x.ravel(), y.ravel(), z.ravel())).astype(numpy.float32)
+
+    # normals of the height field
+    dzdx = 0.4 * numpy.cos(4.0 * x) * numpy.cos(4.0 * y)
+    dzdy = -0.4 * numpy.sin(4.0 * x) * numpy.sin(4.0 * y)
+    normals = numpy.column_stack((-dzdx.ravel(), -dzdy.ravel(), numpy.ones(co.shape[0])))
+    normals = (normals / numpy.linalg.norm(normals, axis=1)[:, None]).astype(numpy.float32)
+
+    # quads counter-clockwise; vertex 0 is never last, so it is never mistaken for a triangle
+    row = numpy.arange(ny)[:, None] * (nx + 1)
+    col = numpy.arange(nx)[None, :]
+    v0 = (row + col).ravel()
+    quads = numpy.column_stack((v0 + 1, v0 + nx + 2, v0 + nx + 1, v0)).astype(numpy.uint32)
+
+    if triangles:
+        tri_faces = numpy.zeros((len(quads) * 2, 4), dtype=numpy.uint32)
+        tri_faces[0::2, :3] = quads[:, [0, 1, 2]]
+        tri_faces[1::2, :3] = quads[:, [0, 2, 3]]
+        # a triangle must not end with vertex 0 either
+        tri_faces[1::2, :3] = tri_faces[1::2][:, [2, 0, 1]]
+        face_vertices = tri_faces
+
+    else:
+        face_vertices = quads
+
+    nfaces = len(face_vertices)
+    nsides = numpy.where(face_vertices[:, 3] != 0, 4, 3)
+    corner = numpy.arange(4)[None, :] < nsides[:, None]
+
+    # face normals: average of the corner normals
+    face_normals = (normals[face_vertices] * corner[:, :, None]).sum(axis=1)
+    face_normals = (face_normals / numpy.linalg.norm(face_normals, axis=1)[:, None]).astype(numpy.float32)
+
+    face_smooth = rng.random_sample(nfaces) < smooth
+    face_material = (numpy.arange(nfaces) * materials // max(nfaces, 1)).astype(numpy.int16)
+
+    face_uv = None
+
+    if uv == 'seamless':
+        face_uv = numpy.zeros((nfaces, 4, 2), dtype=numpy.float32)
+        face_uv[:] = (co[face_vertices][:, :, :2] + 1.0) * 0.5
+        face_uv[~corner] = 0.0
+
+    elif uv == 'faces':
+        square = numpy.array([[0.0, 0.0], [1.0, 0.0], [1.0, 1.0], [0.0, 1.0]], dtype=numpy.float32)
+        face_uv = numpy.tile(square, (nfaces, 1, 1))
+        face_uv[~corner] = 0.0
+
+    face_colors = None
+
+    if colors:
+        face_colors = rng.random_sample((nfaces, 4, 3)).astype(numpy.float32)
+
+    name = 'grid_%d' % nfaces
+
+    return FakeMesh(
+        name, co, normals, face_vertices, face_smooth, face_normals, face_material,
+        face_uv,
+        face_colors
+    )
+
+
+# named fixture presets: keyword arguments of grid_mesh
+FIXTURES = {
+    'smooth': {'smooth': 1.0},
+    'flat': {'smooth': 0.0},
+    'uv': {'smooth': 1.0, 'uv': 'seamless'},
+    'mixed': {'smooth': 0.7, 'uv': 'faces', 'colors': True, 'materials': 3},
+    'triangles': {'smooth': 1.0, 'uv': 'seamless', 'triangles': True},
+}
+
+
+def make_fixture(name, faces, seed=0):
+    return grid_mesh(faces, seed=seed, **FIXTURES[name])
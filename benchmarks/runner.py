@@ -0,0 +1,185 @@
+# -*- coding: utf8 -*-
+#
+# ***** BEGIN GPL LICENSE BLOCK *****
+#
+# --------------------------------------------------------------------------
+# Blender Mitsuba Add-On
+# --------------------------------------------------------------------------
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+#
+# ***** END GPL LICENSE BLOCK *****
+
+
+import os
+import gc
+import sys
+import time
+import shutil
+import platform
+import tempfile
+import tracemalloc
+
+from collections import OrderedDict
+
+import numpy
+
+from . import outputs_module
+
+mesh_buffers = outputs_module('mesh_buffers')
+mesh_ply = outputs_module('mesh_ply')
+mesh_serialized = outputs_module('mesh_serialized')
+
+
+def collate_faces(mesh):
+    # group the tessfaces by material index, as GeometryExporter.writeMesh does
+    ffaces_mats = {}
+
+    for f in mesh.tessfaces:
+        ffaces_mats.setdefault(f.material_index, []).append(f)
+
+    return ffaces_mats
+
+
+def serialized_python(mesh, path, options):
+    compressor = mesh_serialized.MeshCompressor(parallel=options['parallel'])
+
+    for i, faces in collate_faces(mesh).items():
+        mesh_serialized.write_serialized_mesh(path % i, mesh.name, mesh, faces, compressor, options['precision'])
+
+
+def serialized_numpy(mesh, path, options):
+    compressor = mesh_serialized.MeshCompressor(parallel=options['parallel'])
+    buffers = mesh_buffers.MeshBuffers(mesh)
+
+    for i, submesh in buffers.split_materials().items():
+        mesh_serialized.write_serialized_submesh(path % i, mesh.name, submesh, compressor, options['precision'])
+
+
+def serialized_streamed(mesh, path, options):
+    compressor = mesh_serialized.MeshCompressor(parallel=options['parallel'])
+    buffers = mesh_buffers.MeshBuffers(mesh)
+
+    for i in buffers.material_indices():
+        mesh_serialized.write_serialized_streamed(path % i, mesh.name, buffers, buffers.material_faces(i),
+                                                  compressor, options['precision'], options['memory_limit'])
+
+
+def ply_python(mesh, path, options):
+    for i, faces in collate_faces(mesh).items():
+        mesh_ply.write_ply_mesh(path % i, mesh.name, mesh, faces)
+
+
+def ply_numpy(mesh, path, options):
+    buffers = mesh_buffers.MeshBuffers(mesh)
+
+    for i, submesh in buffers.split_materials().items():
+        mesh_ply.write_ply_submesh(path % i, mesh.name, submesh)
+
+
+# writer name: (file format, function, option values to run)
+WRITERS = OrderedDict([
+    ('serialized/python', ('serialized', serialized_python, {'precision': ['double', 'single'], 'parallel': [False, True]})),
+    ('serialized/numpy', ('serialized', serialized_numpy, {'precision': ['double', 'single'], 'parallel': [False, True]})),
+    ('serialized/streamed', ('serialized', serialized_streamed, {'precision': ['double'], 'parallel': [False], 'memory_limit': [64 << 20]})),
+    ('ply/python', ('ply', ply_python, {})),
+    ('ply/numpy', ('ply', ply_numpy, {})),
+])
+
+
+def option_sets(values):
+    '''
+    values              dict of option name: list of values
+
+    Returns list of dicts, one per combination of option values
+    '''
+
+    sets = [OrderedDict()]
+
+    for name in sorted(values.keys()):
+        sets = [OrderedDict(list(s.items()) + [(name, v)]) for s in sets for v in values[name]]
+
+    return sets
+
+
+def run_case(mesh, writer, options, repeat=3):
+    '''
+    mesh                FakeMesh
+    writer              name in WRITERS
+    options             dict of writer options
+    repeat              number of timed runs, the fastest is kept
+
+    Returns dict of measurements
+    '''
+
+    file_format, write, _ = WRITERS[writer]
+    work_dir = tempfile.mkdtemp(prefix='mtsblend_bench_')
+    path = os.path.join(work_dir, 'mesh_m%%03d.%s' % file_format)
+
+    try:
+        seconds = None
+
+        for _ in range(repeat):
+            gc.collect()
+            start = time.perf_counter()
+            write(mesh, path, options)
+            elapsed = time.perf_counter() - start
+
+            if seconds is None or elapsed < seconds:
+                seconds = elapsed
+
+        bytes_written = sum(os.path.getsize(os.path.join(work_dir, f)) for f in os.listdir(work_dir))
+
+        # memory is traced in a separate run, tracing slows down allocations
+        gc.collect()
+        tracemalloc.start()
+
+        try:
+            write(mesh, path, options)
+            peak_memory = tracemalloc.get_traced_memory()[1]
+
+        finally:
+            tracemalloc.stop()
+
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    triangles = mesh.triangle_count
+
+    return OrderedDict([
+        ('writer', writer),
+        ('format', file_format),
+        ('options', options),
+        ('faces', len(mesh.tessfaces)),
+        ('triangles', triangles),
+        ('seconds', seconds),
+        ('triangles_per_second', triangles / seconds if seconds > 0 else None),
+        ('bytes', bytes_written),
+        ('peak_memory', peak_memory),
+    ])
+
+
+def case_key(result):
+    # identifies the same case across result files
+    return (result['fixture'], result['faces'], result['writer'], tuple(sorted(result['options'].items())))
+
+
+def environment():
+    return OrderedDict([
+        ('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('python', sys.version.split()[0]),
+        ('numpy', numpy.__version__),
+        ('platform', platform.platform()),
+        ('cpu_count', os.cpu_count()),
+    ])
@@ -26,22 +26,11 @@ import bpy
 from bpy.app.handlers import persistent
 
 from ..nodes import MitsubaNodeManager
-from ..export.geometry import GeometryExporter
 from ..outputs import MtsLog
 
 
 @persistent
 def mts_scene_update(context):
-    if bpy.data.objects.is_updated:
-        for ob in bpy.data.objects:
-            if ob is None:
-                continue
-
-            # only flag as updated if either modifiers or
-            # mesh data is updated
-            if ob.is_updated_data or (ob.data is not None and ob.data.is_updated):
-                GeometryExporter.KnownModifiedObjects.add(ob)
-
     if bpy.data.node_groups.is_updated:
         context.mitsuba_nodegroups.refresh()
 
@@ -53,8 +42,7 @@ def mts_node_manager_lock(context):
 
 @persistent
 def mts_scene_load(context):
-    # clear known list on scene load and unlock node manager
-    GeometryExporter.KnownExportedObjects = set()
+    # unlock node manager on scene load
     MitsubaNodeManager.unlock()
 
 if hasattr(bpy.app, 'handlers') and hasattr(bpy.app.handlers, 'scene_update_post'):
@@ -24,9 +24,13 @@
 from collections import OrderedDict, Counter
 
 import os
+import sys
 
 import bpy
 import mathutils
+import numpy
+
+from bpy_extras.io_utils import axis_conversion
 
 from ..extensions_framework import util as efutil
 
@@ -53,15 +57,54 @@ class ExportProgressThread(efutil.TimerThread):
             MtsLog(self.message % pc)
 
 
+def approx_size(item):
+    '''
+    item                python object
+
+    Rough memory footprint of item, following tuples, lists, sets and dicts.
+
+    Returns int
+    '''
+
+    size = sys.getsizeof(item)
+
+    if isinstance(item, dict):
+        size += sum(approx_size(k) + approx_size(v) for k, v in item.items())
+
+    elif isinstance(item, (tuple, list, set, frozenset)):
+        size += sum(approx_size(i) for i in item)
+
+    return size
+
+
 class ExportCache:
-    def __init__(self, name='Cache'):
+    '''
+    Cache of exported items.
+
+    With a max_items or max_bytes budget, the least recently used items
+    are evicted to stay within it. Items added with evictable=False are
+    kept for the whole export and don't count towards the budget.
+    Hits, misses, evictions and the approximate bytes held are counted
+    for the export log.
+    '''
+
+    def __init__(self, name='Cache', max_items=0, max_bytes=0):
         self.name = name
-        self.cache_keys = set()
-        self.cache_items = {}
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.cache_items = OrderedDict()
+        self.pinned_items = {}
+        self.item_sizes = {}
         self.serial_counter = Counter()
 
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_held = 0
+        self.evictable_bytes = 0
+
     def clear(self):
-        self.__init__(name=self.name)
+        self.__init__(name=self.name, max_items=self.max_items, max_bytes=self.max_bytes)
 
     def serial(self, name):
         s = self.serial_counter[name]
@@ -70,18 +113,91 @@ class ExportCache:
         return s
 
     def have(self, ck):
-        return ck in self.cache_keys
+        if ck in self.cache_items:
+            self.hits += 1
+            self.cache_items.move_to_end(ck)
+            return True
 
-    def add(self, ck, ci):
-        self.cache_keys.add(ck)
-        self.cache_items[ck] = ci
+        if ck in self.pinned_items:
+            self.hits += 1
+            return True
+
+        self.misses += 1
+        return False
 
-    def get(self, ck):
-        if self.have(ck):
-            return self.cache_items[ck]
+    def add(self, ck, ci, evictable=True):
+        self.discard(ck)
+
+        size = approx_size(ck) + approx_size(ci)
+        self.item_sizes[ck] = size
+        self.bytes_held += size
+
+        if evictable:
+            self.cache_items[ck] = ci
+            self.evictable_bytes += size
+            self.evict()
 
         else:
-            raise Exception('Item %s not found in %s!' % (ck, self.name))
+            self.pinned_items[ck] = ci
+
+    def discard(self, ck):
+        size = self.item_sizes.pop(ck, 0)
+        self.bytes_held -= size
+
+        if self.cache_items.pop(ck, _missing) is not _missing:
+            self.evictable_bytes -= size
+
+        else:
+            self.pinned_items.pop(ck, None)
+
+    def evict(self):
+        while self.cache_items and (
+                (self.max_items > 0 and len(self.cache_items) > self.max_items) or
+                (self.max_bytes > 0 and self.evictable_bytes > self.max_bytes)):
+            ck, ci = self.cache_items.popitem(last=False)
+            size = self.item_sizes.pop(ck, 0)
+            self.bytes_held -= size
+            self.evictable_bytes -= size
+            self.evictions += 1
+
+    def get(self, ck, default=None):
+        '''
+        ck                  cache key
+        default             returned when ck is not cached
+
+        Returns the cached item, or default
+        '''
+
+        try:
+            ci = self.cache_items[ck]
+            self.cache_items.move_to_end(ck)
+
+        except KeyError:
+            try:
+                ci = self.pinned_items[ck]
+
+            except KeyError:
+                self.misses += 1
+                return default
+
+        self.hits += 1
+        return ci
+
+    def values(self):
+        return list(self.cache_items.values()) + list(self.pinned_items.values())
+
+    def stats(self):
+        return '%s: %d hits, %d misses, %d evictions, %d items, %.1f KB held' % (
+            self.name,
+            self.hits,
+            self.misses,
+            self.evictions,
+            len(self.cache_items) + len(self.pinned_items),
+            self.bytes_held / 1024.0
+        )
+
+
+_missing = object()
 
 
 class ExportContextBase:
@@ -114,6 +230,40 @@ class ExportContextBase:
         else:
             return efutil.filesystem_path(path)
 
+    def convert_matrices(self, matrices):
+        '''
+        matrices      numpy.ndarray (n, 4, 4) of Blender matrices
+
+        Convert matrices to Mitsuba axes and world scale in bulk, giving
+        the lists transform_matrix builds one matrix at a time
+
+        Returns numpy.ndarray (n, 16)
+        '''
+
+        # Blender is Z up but Mitsuba is Y up, convert the matrices
+        global_matrix = numpy.array(axis_conversion(to_forward="-Z", to_up="Y").to_4x4())
+
+        return matrices_to_array(numpy.einsum('ij,njk->nik', global_matrix, matrices))
+
+    def convert_matrix(self, matrix):
+        '''
+        matrix        Matrix in Blender space
+
+        Returns list[16] of the matrix converted to Mitsuba space
+        '''
+
+        # Blender is Z up but Mitsuba is Y up, convert the matrix
+        global_matrix = axis_conversion(to_forward="-Z", to_up="Y").to_4x4()
+
+        return matrix_to_list(global_matrix * matrix)
+
+    def transform_matrix(self, matrix):
+        return self.transform_list(self.convert_matrix(matrix))
+
+    def animated_transform(self, motion):
+        # the API contexts only build transforms from converted lists
+        return self.animated_transform_list([(t, self.convert_matrix(m)) for (t, m) in motion])
+
     def exportMedium(self, scene, medium):
         if medium.name in self.exported_media:
             return
@@ -182,6 +332,26 @@ class Instance:
             self.motion.append((seq, trafo))
 
 
+class ParticleInstance(Instance):
+    '''
+    Instances of the meshes of an object placed by a particle system. Every
+    motion sample holds (matrices, visible) from particle_matrices, indexed
+    by particle, so that a particle has the same index in all samples.
+    '''
+
+    psys = None
+
+    def __init__(self, obj, psys, particles, mesh):
+        super().__init__(obj, particles, mesh)
+        self.psys = psys
+
+    def append_motion(self, particles, seq, is_deform=False):
+        # the particles of a system don't change within a frame, a sample
+        # with another count can't be matched and is left out
+        if len(particles[0]) == len(self.motion[0][1][0]):
+            self.motion.append((seq, particles))
+
+
 class ReferenceCounter:
     stack = []
 
@@ -306,6 +476,76 @@ def is_object_visible(scene, obj, is_dupli=False):
     return (ov or is_dupli) and not obj.hide_render
 
 
+def layer_mask(layers):
+    '''
+    layers              sequence of bools, one per layer
+
+    Returns int bitmask of the enabled layers
+    '''
+
+    mask = 0
+
+    for i, enabled in enumerate(layers):
+        if enabled:
+            mask |= 1 << i
+
+    return mask
+
+
+class VisibilityTable:
+    '''
+    Layer visibility and render hide state of the objects of an export.
+
+    Layer bitmasks and object_render_hide results are computed once per
+    object, instead of for every motion sample and every dupli.
+    '''
+
+    def __init__(self, scene):
+        self.scene = scene
+        self.layers = layer_mask(scene.layers) & layer_mask(scene.render.layers.active.layers)
+        self.layer_masks = {}       # object: layer bitmask
+        self.render_hides = {}      # (object, top_level, parent_hide): (hide_obj, hide_mesh)
+        self.dupli_hides = {}       # object: bool
+
+    def is_visible(self, obj, is_dupli=False):
+        """
+        Same as is_object_visible(self.scene, obj, is_dupli)
+        """
+
+        mask = self.layer_masks.get(obj)
+
+        if mask is None:
+            mask = self.layer_masks[obj] = layer_mask(obj.layers)
+
+        # hide_render may be animated, so it is not cached
+        return (mask & self.layers != 0 or is_dupli) and not obj.hide_render
+
+    def render_hide(self, obj, top_level, parent_hide):
+        """
+        Same as object_render_hide(obj, top_level, parent_hide)
+        """
+
+        key = (obj, top_level, parent_hide)
+        hide = self.render_hides.get(key)
+
+        if hide is None:
+            hide = self.render_hides[key] = object_render_hide(obj, top_level, parent_hide)
+
+        return hide
+
+    def hide_duplis(self, obj):
+        """
+        Same as object_render_hide_duplis(obj)
+        """
+
+        hide = self.dupli_hides.get(obj)
+
+        if hide is None:
+            hide = self.dupli_hides[obj] = object_render_hide_duplis(obj)
+
+        return hide
+
+
 def is_light(obj):
     return obj.type == 'LAMP'
 
@@ -331,11 +571,13 @@ def is_subd_displace_last(obj):
 # Currently assumes too much is deforming when it isn't
 
 
+DEFORMING_MODIFIERS = {'ARMATURE', 'CAST', 'CLOTH', 'CURVE', 'DISPLACE',
+                       'HOOK', 'LATTICE', 'MESH_DEFORM', 'SHRINKWRAP',
+                       'SIMPLE_DEFORM', 'SMOOTH', 'WAVE', 'SOFT_BODY',
+                       'SURFACE', 'MESH_CACHE'}
+
+
 def is_deforming(obj):
-    deforming_modifiers = {'ARMATURE', 'CAST', 'CLOTH', 'CURVE', 'DISPLACE',
-                           'HOOK', 'LATTICE', 'MESH_DEFORM', 'SHRINKWRAP',
-                           'SIMPLE_DEFORM', 'SMOOTH', 'WAVE', 'SOFT_BODY',
-                           'SURFACE', 'MESH_CACHE'}
     if obj.type in {'MESH', 'SURFACE', 'FONT'} and obj.modifiers:
         # special cases for auto subd/displace detection
         if len(obj.modifiers) == 1 and is_subd_last(obj):
@@ -344,12 +586,78 @@ def is_deforming(obj):
             return False
 
         for mod in obj.modifiers:
-            if mod.type in deforming_modifiers:
+            if mod.type in DEFORMING_MODIFIERS:
                 return True
 
     return False
 
 
+def is_animated(id_data):
+    anim = getattr(id_data, 'animation_data', None)
+
+    return anim is not None and (anim.action is not None or len(anim.drivers) > 0)
+
+
+def rna_signature(data):
+    '''
+    data                bpy_struct
+
+    Returns tuple of the values of the editable, non-collection
+    properties of data
+    '''
+
+    return tuple(
+        (prop.identifier, repr(getattr(data, prop.identifier)))
+        for prop in data.bl_rna.properties
+        if not prop.is_readonly and prop.type not in {'COLLECTION', 'POINTER'}
+    )
+
+
+def tessellation_key(obj):
+    '''
+    obj                 bpy.types.Object
+
+    Key of the render mesh of a curve, surface or text object, made of its
+    datablock, its curve and resolution settings, its modifier settings
+    and its materials.
+
+    Returns tuple, or None if the render mesh may change between frames
+    and subframes and can't be cached
+    '''
+
+    if obj.type not in {'CURVE', 'SURFACE', 'FONT'}:
+        return None
+
+    curve = obj.data
+
+    if is_animated(obj) or is_animated(curve) or (curve.shape_keys is not None and is_animated(curve.shape_keys)):
+        return None
+
+    # bevel and taper shapes are tessellated along with the curve
+    for shape_obj in (getattr(curve, 'bevel_object', None), getattr(curve, 'taper_object', None)):
+        if shape_obj is not None and (is_animated(shape_obj) or is_animated(shape_obj.data)):
+            return None
+
+    for mod in obj.modifiers:
+        if mod.type in DEFORMING_MODIFIERS:
+            return None
+
+        # modifiers using other objects change with them
+        for prop in mod.bl_rna.properties:
+            if prop.type == 'POINTER':
+                value = getattr(mod, prop.identifier)
+
+                if isinstance(value, bpy.types.Object) and is_animated(value):
+                    return None
+
+    return (
+        curve,
+        rna_signature(curve),
+        tuple((mod.type, rna_signature(mod)) for mod in obj.modifiers),
+        tuple(slot.material for slot in obj.material_slots),
+    )
+
+
 def get_worldscale(as_scalematrix=True):
     ws = 1
 
@@ -429,6 +737,307 @@ def matrix_to_list(matrix, apply_worldscale=True):
     return [float(i) for i in l]
 
 
+def matrices_to_array(matrices, apply_worldscale=True):
+    '''
+    matrices      numpy.ndarray (n, 4, 4)
+
+    Flatten an array of 4x4 matrices, as matrix_to_list does one by one
+
+    Returns numpy.ndarray (n, 16)
+    '''
+
+    matrices = numpy.array(matrices, dtype=numpy.float64).reshape((-1, 4, 4))
+
+    if apply_worldscale:
+        ws = get_worldscale(as_scalematrix=False)
+        # multiply by the scale matrix, then scale the translation
+        matrices[:, :, :3] *= ws
+        matrices[:, :3, 3] *= ws
+
+    return matrices.reshape((-1, 16))
+
+
+# Deviation of an interpolated transform from a dropped motion key, relative
+# to the magnitude of the matrix values, about what scene files can represent
+MOTION_TOLERANCE = 1e-6
+
+
+def interpolate_rotations(rot_a, rot_b, alphas):
+    '''
+    rot_a, rot_b        numpy.ndarray (n, 3, 3) rotation matrices
+    alphas              numpy.ndarray (m,) of interpolation factors
+
+    Interpolate along the shortest arc between pairs of rotations, as the
+    slerp of their quaternions does.
+
+    Returns (numpy.ndarray (n, m, 3, 3) of rotations, numpy.ndarray (n,) of
+    bool, False for the rotations more than 90 degrees apart)
+    '''
+
+    relative = numpy.einsum('nji,njk->nik', rot_a, rot_b)
+    angle = numpy.arccos(numpy.clip((numpy.trace(relative, axis1=1, axis2=2) - 1.0) / 2.0, -1.0, 1.0))
+
+    # far apart rotations may be interpolated the long way by Mitsuba
+    valid = angle <= numpy.pi / 2
+
+    # the axis of tiny rotations is left at zero, they are not interpolated
+    small = angle < 1e-9
+    axis = numpy.array([
+        relative[:, 2, 1] - relative[:, 1, 2],
+        relative[:, 0, 2] - relative[:, 2, 0],
+        relative[:, 1, 0] - relative[:, 0, 1],
+    ]).T / numpy.where(small, 1.0, 2.0 * numpy.sin(angle))[:, None]
+    axis[small] = 0.0
+
+    cross = numpy.zeros((len(angle), 3, 3))
+    cross[:, 0, 1] = -axis[:, 2]
+    cross[:, 0, 2] = axis[:, 1]
+    cross[:, 1, 0] = axis[:, 2]
+    cross[:, 1, 2] = -axis[:, 0]
+    cross[:, 2, 0] = -axis[:, 1]
+    cross[:, 2, 1] = axis[:, 0]
+
+    # Rodrigues' formula for the partial rotations
+    angles = angle[:, None] * alphas[None, :]
+    partial = numpy.eye(3)[None, None] + \
+        numpy.sin(angles)[:, :, None, None] * cross[:, None] + \
+        (1.0 - numpy.cos(angles))[:, :, None, None] * numpy.einsum('nij,njk->nik', cross, cross)[:, None]
+
+    return numpy.einsum('nij,nmjk->nmik', rot_a, partial), valid
+
+
+def interpolated_fit(times, matrices, tolerance=MOTION_TOLERANCE):
+    '''
+    times               numpy.ndarray (k,) of key times
+    matrices            numpy.ndarray (n, k, 4, 4) of the keys of n motions
+    tolerance           float, relative deviation allowed
+
+    Check for every motion whether Mitsuba's interpolation of its first and
+    last keys gives its other keys. Mitsuba splits animated transforms into
+    translation, rotation and stretch, which it interpolates linearly, the
+    rotation by slerp.
+
+    Returns numpy.ndarray (n,) of bool
+    '''
+
+    n, k = matrices.shape[:2]
+
+    if k < 3:
+        return numpy.ones(n, dtype=numpy.bool_)
+
+    if times[-1] <= times[0]:
+        return numpy.zeros(n, dtype=numpy.bool_)
+
+    tol = tolerance * numpy.maximum(1.0, numpy.abs(matrices).reshape((n, -1)).max(axis=1))
+    linear = matrices[:, :, :3, :3]
+    translations = matrices[:, :, :3, 3]
+
+    # projective and mirroring transforms are kept as they are
+    fits = (numpy.abs(matrices[:, :, 3] - [0.0, 0.0, 0.0, 1.0]).max(axis=(1, 2)) <= tol) & \
+        (numpy.linalg.det(linear) > 0).all(axis=1)
+
+    # polar decomposition, linear = rotation * stretch
+    u, s, vt = numpy.linalg.svd(linear)
+    rotations = numpy.einsum('nkij,nkjl->nkil', u, vt)
+    stretches = numpy.einsum('nkji,nkj,nkjl->nkil', vt, s, vt)
+
+    alphas = (times[1:-1] - times[0]) / (times[-1] - times[0])
+    rots, valid = interpolate_rotations(rotations[:, 0], rotations[:, -1], alphas)
+
+    def lerp(values):
+        return values[:, :1] + alphas.reshape((1, -1) + (1,) * (values.ndim - 2)) * (values[:, -1:] - values[:, :1])
+
+    translation_error = numpy.abs(lerp(translations) - translations[:, 1:-1]).max(axis=(1, 2))
+    linear_error = numpy.abs(numpy.einsum('nmij,nmjl->nmil', rots, lerp(stretches)) - linear[:, 1:-1]).max(axis=(1, 2, 3))
+
+    return fits & valid & (translation_error <= tol) & (linear_error <= tol)
+
+
+def linear_motions(times, matrices, starts, tolerance=MOTION_TOLERANCE):
+    '''
+    times               list of the key times of every motion
+    matrices            numpy.ndarray (N, 4, 4) of the keys of all motions
+    starts              numpy.ndarray (n,) of the index of the first key of
+                        every motion
+    tolerance           float, relative deviation allowed
+
+    interpolated_fit of many motions at once, the motions with the same key
+    times are checked together.
+
+    Returns numpy.ndarray (n,) of bool, True for the motions of more than
+    two keys that only need their first and last keys
+    '''
+
+    linear = numpy.zeros(len(times), dtype=numpy.bool_)
+    groups = {}
+
+    for n, motion_times in enumerate(times):
+        if len(motion_times) > 2:
+            groups.setdefault(tuple(motion_times), []).append(n)
+
+    for motion_times, members in groups.items():
+        members = numpy.array(members)
+        keys = starts[members][:, None] + numpy.arange(len(motion_times))[None, :]
+        linear[members] = interpolated_fit(numpy.array(motion_times), matrices[keys], tolerance)
+
+    return linear
+
+
+def simplify_motion(motion, tolerance=MOTION_TOLERANCE):
+    '''
+    motion              list of (time, matrix), the matrices being Matrix
+                        objects or flattened lists of 16 values
+    tolerance           float, relative deviation allowed
+
+    Drop the motion keys that the interpolation of their neighbours gives
+    anyway, so an object moving linearly needs two keys instead of one per
+    sample. Bulk exports check many motions at once with linear_motions.
+
+    Returns list of (time, matrix)
+    '''
+
+    if len(motion) < 3:
+        return motion
+
+    times = numpy.array([t for t, m in motion], dtype=numpy.float64)
+    matrices = numpy.array([numpy.reshape(numpy.array(m, dtype=numpy.float64), (4, 4)) for t, m in motion])
+
+    def fits(a, b):
+        # do keys a + 1 .. b - 1 lie on the interpolation of keys a and b
+        return interpolated_fit(times[a:b + 1], matrices[None, a:b + 1], tolerance)[0]
+
+    last = len(motion) - 1
+
+    if fits(0, last):
+        kept = [0, last]
+
+    else:
+        kept = [0]
+        a = 0
+
+        for b in range(2, last + 1):
+            if not fits(a, b):
+                a = b - 1
+                kept.append(a)
+
+        kept.append(last)
+
+    return [motion[k] for k in kept]
+
+
+def quaternions_to_matrices(quats):
+    '''
+    quats         numpy.ndarray (n, 4) of w, x, y, z quaternions
+
+    Returns numpy.ndarray (n, 3, 3) of rotation matrices
+    '''
+
+    quats = numpy.array(quats, dtype=numpy.float64).reshape((-1, 4))
+    norms = numpy.sqrt((quats * quats).sum(axis=1))
+    norms[norms == 0] = 1.0
+    w, x, y, z = (quats / norms[:, None]).T
+
+    matrices = numpy.empty((len(quats), 3, 3), dtype=numpy.float64)
+    matrices[:, 0, 0] = 1 - 2 * (y * y + z * z)
+    matrices[:, 0, 1] = 2 * (x * y - w * z)
+    matrices[:, 0, 2] = 2 * (x * z + w * y)
+    matrices[:, 1, 0] = 2 * (x * y + w * z)
+    matrices[:, 1, 1] = 1 - 2 * (x * x + z * z)
+    matrices[:, 1, 2] = 2 * (y * z - w * x)
+    matrices[:, 2, 0] = 2 * (x * z - w * y)
+    matrices[:, 2, 1] = 2 * (y * z + w * x)
+    matrices[:, 2, 2] = 1 - 2 * (x * x + y * y)
+
+    return matrices
+
+
+def is_bulk_particle_system(psys):
+    '''
+    Emitter systems placing objects without children can be exported in
+    bulk, other systems go through the dupli list. Hair systems place their
+    objects along the hair paths, and global dupli coordinates add the
+    location of the object, neither is done by particle_matrices.
+    '''
+
+    settings = psys.settings
+
+    return settings.type == 'EMITTER' and settings.render_type == 'OBJECT' and \
+        settings.child_type == 'NONE' and not settings.use_global_dupli and \
+        settings.dupli_object is not None and is_mesh(settings.dupli_object)
+
+
+def particle_matrices(scene, psys, dupli_obj):
+    '''
+    scene         bpy.types.Scene, at the time of the particle state
+    psys          bpy.types.ParticleSystem
+    dupli_obj     bpy.types.Object placed by the particles
+
+    World matrices of the particles of an object particle system, read in
+    bulk and built as Blender places the dupli objects. All particles are
+    kept, so that they have the same index in every motion sample.
+
+    Returns (numpy.ndarray (n, 4, 4) of matrices, numpy.ndarray (n,) of
+    the visibility of the particles)
+    '''
+
+    settings = psys.settings
+    particles = psys.particles
+    count = len(particles)
+
+    location = numpy.empty(count * 3, dtype=numpy.float32)
+    rotation = numpy.empty(count * 4, dtype=numpy.float32)
+    size = numpy.empty(count, dtype=numpy.float32)
+    birth_time = numpy.empty(count, dtype=numpy.float32)
+    die_time = numpy.empty(count, dtype=numpy.float32)
+    exists = numpy.empty(count, dtype=numpy.bool_)
+
+    if count > 0:
+        particles.foreach_get('location', location)
+        particles.foreach_get('rotation', rotation)
+        particles.foreach_get('size', size)
+        particles.foreach_get('birth_time', birth_time)
+        particles.foreach_get('die_time', die_time)
+        particles.foreach_get('is_exist', exists)
+
+    frame = scene.frame_current + scene.frame_subframe
+    visible = exists.copy()
+
+    if not settings.show_unborn:
+        visible &= birth_time <= frame
+
+    if not settings.use_dead:
+        visible &= die_time >= frame
+
+    # rotation and scale of the dupli object itself
+    dupli_matrix = dupli_obj.matrix_world.to_3x3()
+
+    if not settings.use_rotation_dupli:
+        # particles are aligned along the X axis, the object is pre-rotated accordingly
+        track_axis = dupli_obj.track_axis.replace('POS_', '').replace('NEG_', '-')
+        dupli_scale = dupli_matrix.to_scale()
+        dupli_matrix = mathutils.Vector((-1.0, 0.0, 0.0)).to_track_quat(track_axis, dupli_obj.up_axis).to_matrix()
+
+        if settings.use_scale_dupli:
+            dupli_matrix = dupli_matrix * mathutils.Matrix((
+                (dupli_scale[0], 0.0, 0.0),
+                (0.0, dupli_scale[1], 0.0),
+                (0.0, 0.0, dupli_scale[2]),
+            ))
+
+    elif not settings.use_scale_dupli:
+        dupli_matrix.normalize()
+
+    rotations = quaternions_to_matrices(rotation.reshape((-1, 4)))
+    rotations *= size[:, None, None]
+
+    matrices = numpy.zeros((count, 4, 4), dtype=numpy.float64)
+    matrices[:, :3, :3] = numpy.einsum('nij,jk->nik', rotations, numpy.array(dupli_matrix))
+    matrices[:, :3, 3] = location.reshape((-1, 3))
+    matrices[:, 3, 3] = 1.0
+
+    return matrices, visible
+
+
 def compute_normalized_radiance(emitter, color):
     max_color = max(color[:])
 
@@ -454,5 +1063,18 @@ def get_output_subdir(scene, frame=None):
     return subdir
 
 
+def get_static_subdir(scene):
+    '''
+    Folder of the meshes shared by all frames of the scene
+    '''
+
+    subdir = os.path.join(efutil.export_path, efutil.scene_filename(), bpy.path.clean_name(scene.name), 'static')
+
+    if not os.path.exists(subdir):
+        os.makedirs(subdir)
+
+    return subdir
+
+
 def get_output_filename(scene):
     return '%s.%s.%05d' % (efutil.scene_filename(), bpy.path.clean_name(scene.name), scene.frame_current)
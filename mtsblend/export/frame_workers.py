@@ -0,0 +1,372 @@
+# -*- coding: utf8 -*-
+#
+# ***** BEGIN GPL LICENSE BLOCK *****
+#
+# --------------------------------------------------------------------------
+# Blender Mitsuba Add-On
+# --------------------------------------------------------------------------
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+#
+# ***** END GPL LICENSE BLOCK *****
+
+'''
+Export of a frame range by several background Blender processes.
+
+This file is both imported by the add-on and run as a script. Run by a
+background Blender with --worker, it exports a slice of the frames of the
+loaded .blend file. Run by any Python interpreter, it is a command line
+driver, for example:
+
+    python frame_workers.py scene.blend --frames 1-250 --workers 4 \\
+        --directory /tmp/out --filename scene.xml --blender /path/to/blender
+
+Only the standard library is imported at module level, the worker imports
+the add-on from inside Blender.
+'''
+
+import os
+import sys
+import argparse
+import threading
+import subprocess
+import traceback
+import importlib
+
+# Prefix of the lines a worker prints for the driver
+WORKER_PREFIX = 'MTSBLEND_FRAME'
+
+
+def partition_frames(frames, workers):
+    '''
+    frames              list of frame numbers
+    workers             int number of worker processes
+
+    Split the frames into contiguous slices of nearly the same size, so that
+    every worker still shares the motion samples of consecutive frames.
+
+    Returns list of lists of frame numbers
+    '''
+
+    frames = sorted(set(frames))
+    workers = max(1, min(workers, len(frames)))
+    size, extra = divmod(len(frames), workers)
+    slices = []
+    start = 0
+
+    for i in range(workers):
+        end = start + size + (1 if i < extra else 0)
+        slices.append(frames[start:end])
+        start = end
+
+    return [s for s in slices if s]
+
+
+def format_frames(frames):
+    '''
+    frames              list of frame numbers
+
+    Returns str of comma separated frame numbers and ranges, like 1-10,12
+    '''
+
+    ranges = []
+
+    for frame in sorted(set(frames)):
+        if ranges and frame == ranges[-1][1] + 1:
+            ranges[-1][1] = frame
+
+        else:
+            ranges.append([frame, frame])
+
+    return ','.join(str(a) if a == b else '%d-%d' % (a, b) for a, b in ranges)
+
+
+def parse_frames(text):
+    '''
+    text                str from format_frames()
+
+    Returns list of frame numbers
+    '''
+
+    frames = []
+
+    for part in text.split(','):
+        if not part:
+            continue
+
+        # negative frames are allowed, so split at the first '-' after a digit
+        first, sep, last = part[1:].partition('-')
+
+        if sep:
+            frames.extend(range(int(part[0] + first), int(last) + 1))
+
+        else:
+            frames.append(int(part))
+
+    return frames
+
+
+class FrameRangeExport:
+    '''
+    Export a frame range with several background Blender processes.
+
+    The frames are partitioned into one contiguous slice per worker. Every
+    worker loads the .blend file, exports its slice with SceneExporter, and
+    reports progress and the result of each frame on its standard output.
+    '''
+
+    def __init__(self, blend_path, frames, directory, filename, workers=2,
+                 scene='', shared_includes=False, package='mtsblend', blender='blender'):
+        self.blend_path = blend_path
+        self.frames = sorted(set(frames))
+        self.directory = directory
+        self.filename = filename
+        self.scene = scene
+        self.shared_includes = shared_includes
+        self.package = package
+        self.blender = blender
+        self.slices = partition_frames(self.frames, workers)
+
+        self.processes = []
+        self.results = {}       # frame: export result
+        self.exported = set()   # frames written, the shared files may still be missing
+        self.logs = []          # worker index: list of output lines
+        self.lock = threading.Lock()
+
+    def worker_command(self, frames):
+        '''
+        frames              list of frame numbers of the worker
+
+        Returns list of command line arguments
+        '''
+
+        args = [
+            self.blender, '-b', self.blend_path,
+            '--python', os.path.abspath(__file__),
+            '--',
+            '--worker',
+            '--package', self.package,
+            '--directory', self.directory,
+            '--filename', self.filename,
+            '--frames', format_frames(frames),
+        ]
+
+        if self.scene:
+            args.extend(['--scene', self.scene])
+
+        if self.shared_includes:
+            args.append('--shared-includes')
+
+            # every worker finds the shared elements of its own slice
+            if len(self.slices) > 1:
+                base_name = self.filename[:-4] if self.filename.endswith('.xml') else self.filename
+                args.extend(['--shared-name', '%s.shared.%05d-%05d.xml' % (base_name, frames[0], frames[-1])])
+
+        return args
+
+    def read_output(self, index, stream, progress):
+        for line in stream:
+            line = line.rstrip()
+            words = line.split()
+
+            with self.lock:
+                if len(words) >= 3 and words[0] == WORKER_PREFIX:
+                    frame = int(words[2])
+
+                    if words[1] == 'progress':
+                        self.exported.add(frame)
+
+                        if progress is not None:
+                            progress(len(self.exported), len(self.frames))
+
+                    elif words[1] == 'result':
+                        self.results[frame] = set(words[3:])
+
+                else:
+                    self.logs[index].append(line)
+
+    def run(self, progress=None):
+        '''
+        progress            function called with the number of exported
+                            frames and the total number of frames
+
+        Start the workers and wait until all have finished.
+
+        Returns dict of frame: export result, frames missing from it were
+        not exported
+        '''
+
+        readers = []
+        self.logs = [[] for s in self.slices]
+
+        try:
+            for index, frames in enumerate(self.slices):
+                process = subprocess.Popen(
+                    self.worker_command(frames),
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                    universal_newlines=True
+                )
+                self.processes.append(process)
+
+                reader = threading.Thread(target=self.read_output, args=(index, process.stdout, progress))
+                reader.start()
+                readers.append(reader)
+
+            for process, reader in zip(self.processes, readers):
+                process.wait()
+                reader.join()
+
+        except:
+            self.cancel()
+            raise
+
+        return self.results
+
+    def cancel(self):
+        for process in self.processes:
+            if process.poll() is None:
+                process.terminate()
+
+    def failed_frames(self):
+        '''
+        Returns list of the frames that were not exported
+        '''
+
+        return [
+            frame for frame in self.frames
+            if frame not in self.results or 'CANCELLED' in self.results[frame]
+        ]
+
+    def failed_workers(self):
+        '''
+        Returns list of (frames, exit code, last output lines) of the workers
+        that did not export all their frames
+        '''
+
+        failed = set(self.failed_frames())
+
+        return [
+            (frames, process.returncode, log[-20:])
+            for frames, process, log in zip(self.slices, self.processes, self.logs)
+            if failed.intersection(frames)
+        ]
+
+
+def run_worker(args):
+    '''
+    args                parsed worker arguments
+
+    Export the frames of the worker in the running Blender, printing the
+    progress and the result of each frame for the driver.
+    '''
+
+    import bpy
+    import addon_utils
+
+    def report(*words):
+        print(WORKER_PREFIX, *words)
+        sys.stdout.flush()
+
+    frames = parse_frames(args.frames)
+
+    try:
+        scene = bpy.data.scenes[args.scene] if args.scene else bpy.context.scene
+
+        if not hasattr(scene, 'mitsuba_engine'):
+            addon_utils.enable(args.package, default_set=False)
+
+        scene_module = importlib.import_module('%s.export.scene' % args.package)
+
+        properties = scene_module.SceneExporterProperties()
+        properties.directory = args.directory
+        properties.filename = args.filename
+        properties.api_type = 'FILE'
+        properties.write_files = True
+        properties.write_all_files = True
+
+        scene_exporter = scene_module.SceneExporter()
+        scene_exporter.set_properties(properties)
+        scene_exporter.set_scene(scene)
+
+        results = scene_exporter.export_frames(
+            frames, args.shared_includes, args.shared_name,
+            frame_done=lambda frame, result: report('progress', frame)
+        )
+
+    except:
+        traceback.print_exc()
+        results = {}
+
+    for frame in frames:
+        result = results.get(frame)
+        report('result', frame, *(sorted(result) if result else ['CANCELLED']))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Export a frame range to Mitsuba scene files with several background Blender processes.')
+    parser.add_argument('blend', nargs='?', default='', help='.blend file to export')
+    parser.add_argument('--frames', required=True, help='frames to export, like 1-250 or 1,5,10-20')
+    parser.add_argument('--directory', required=True, help='target directory')
+    parser.add_argument('--filename', required=True, help='target filename, frame numbers are added to it')
+    parser.add_argument('--scene', default='', help='scene to export, defaults to the active scene')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='number of Blender processes')
+    parser.add_argument('--shared-includes', action='store_true', help='write the elements shared by all frames to include files')
+    parser.add_argument('--shared-name', default='', help=argparse.SUPPRESS)
+    parser.add_argument('--blender', default='blender', help='Blender executable')
+    parser.add_argument('--package', default='mtsblend', help='module name of the installed add-on')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        run_worker(args)
+        return 0
+
+    if not args.blend:
+        parser.error('the .blend file is required')
+
+    def progress(exported, total):
+        print('Exporting frames: %i%%' % int(100 * exported / total))
+
+    export = FrameRangeExport(
+        os.path.abspath(args.blend), parse_frames(args.frames),
+        os.path.abspath(args.directory), args.filename,
+        workers=args.workers, scene=args.scene, shared_includes=args.shared_includes,
+        package=args.package, blender=args.blender
+    )
+    export.run(progress)
+
+    for frames, returncode, log in export.failed_workers():
+        print('Worker of frames %s exited with code %s:' % (format_frames(frames), returncode))
+        print('\n'.join(log))
+
+    failed = export.failed_frames()
+
+    if failed:
+        print('Unsucessful export of frames: %s' % format_frames(failed))
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    # Blender passes the arguments following '--' to the script
+    argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else sys.argv[1:]
+
+    if '--worker' in argv:
+        # leave Blender to exit by itself once the script is done
+        main(argv)
+
+    else:
+        sys.exit(main(argv))
@@ -22,22 +22,35 @@
 # ***** END GPL LICENSE BLOCK *****
 
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import os
-import math
+import functools
+import multiprocessing
 
 import bpy
-import mathutils
+import numpy
+
+from ..extensions_framework import util as efutil
 
 from ..outputs import MtsLog
-from ..outputs.mesh_ply import write_ply_mesh
-from ..outputs.mesh_serialized import write_serialized_mesh
+from ..outputs.mesh_cache import MeshCache
+from ..outputs.hair import resample_bspline, write_hair_ascii, write_hair_binary
+from ..outputs.mesh_buffers import MeshBuffers, MaterialParts, DeformationTopology
+from ..outputs.mesh_ply import write_ply_mesh, write_ply_submesh
+from ..outputs.mesh_serialized import write_serialized_mesh, write_serialized_submesh, write_serialized_streamed, SerializedContainer, MeshCompressor, STREAM_BYTES_PER_FACE
 from ..export import ExportProgressThread, ExportCache
 from ..export import is_deforming
+from ..export import tessellation_key
 from ..export import get_output_subdir
+from ..export import get_static_subdir
 from ..export import get_param_recursive
+from ..export import interpolated_fit, linear_motions
 from ..export.materials import export_material
 
+# Number of particles whose motion is checked at once, bounding the temporary arrays
+PARTICLE_CHUNK = 1 << 16
+
 
 class InvalidGeometryException(Exception):
     #MtsLog("Invalid Geometry Exception ")
@@ -59,35 +72,264 @@ class DupliExportProgressThread(ExportProgressThread):
     message = '... %i%% ...'
 
 
-class GeometryExporter:
+class TessellationCache:
+    '''
+    Render meshes of curve, surface and text objects that don't change,
+    tessellated once and kept for all the exports of a batch of frames.
+    The render mesh of an object is freed when its tessellation key
+    changes and no other object uses it.
+    '''
+
+    def __init__(self):
+        self.meshes = ExportCache('Tessellations')
+        self.object_keys = {}
+
+    def get(self, obj, tess_key):
+        '''
+        obj                 bpy.types.Object
+        tess_key            tessellation_key() of the object, or None
+
+        Returns (render mesh, MeshBuffers or None), or None
+        '''
+
+        old_key = self.object_keys.pop(obj, None)
+
+        if old_key is not None and old_key != tess_key and old_key not in self.object_keys.values():
+            self.release(old_key)
 
-    # for partial mesh export
-    KnownExportedObjects = set()
-    KnownModifiedObjects = set()
-    NewExportedObjects = set()
+        if tess_key is None:
+            return None
 
-    def __init__(self, export_ctx, visibility_scene):
+        self.object_keys[obj] = tess_key
+
+        return self.meshes.get(tess_key)
+
+    def add(self, tess_key, mesh, mesh_buffers):
+        self.meshes.add(tess_key, (mesh, mesh_buffers))
+
+    def release(self, tess_key):
+        tessellation = self.meshes.get(tess_key)
+
+        if tessellation is not None:
+            bpy.data.meshes.remove(tessellation[0])
+            self.meshes.discard(tess_key)
+
+    def stats(self):
+        return self.meshes.stats()
+
+    def clear(self):
+        """
+        Free the cached render meshes, must be called once all meshes are written.
+        """
+
+        for mesh, mesh_buffers in self.meshes.values():
+            bpy.data.meshes.remove(mesh)
+
+        self.meshes.clear()
+        self.object_keys = {}
+
+
+class GeometryExporter:
+
+    def __init__(self, export_ctx, visibility_scene, tessellations=None):
         self.export_ctx = export_ctx
         self.visibility_scene = visibility_scene
 
-        self.ExportedMeshes = ExportCache('ExportedMeshes')
-        self.ExportedObjects = ExportCache('ExportedObjects')
+        engine = visibility_scene.mitsuba_engine
+
+        # Evicted mesh definitions are exported again when needed, file
+        # names are kept for the whole export so they stay unique
+        cache_bytes = engine.export_cache_limit * 1024 * 1024
+        self.ExportedMeshes = ExportCache('ExportedMeshes', max_bytes=cache_bytes)
+        self.ExportedObjects = ExportCache('ExportedObjects', max_bytes=cache_bytes)
         self.ExportedFiles = ExportCache('ExportedFiles')
-        # start fresh
-        GeometryExporter.NewExportedObjects = set()
+        self.FrameContainers = {}
+        self.StaticStores = {}
+        self.DeformTopologies = {}
+        self.GeometryParts = {}
+        self.Tessellations = tessellations if tessellations is not None else TessellationCache()
+        self.sampled_meshes = {}
+        self.share_static_meshes = engine.static_geometry
 
         self.objects_used_as_duplis = set()
 
         self.serializer = None
         self.fast_export = False
 
+        self.compressor = MeshCompressor(
+            level=engine.compression_level,
+            parallel=engine.parallel_compression
+        )
+
+        self.mesh_cache = None
+
+        if engine.partial_export:
+            if engine.mesh_cache_path:
+                cache_path = efutil.filesystem_path(engine.mesh_cache_path)
+
+            else:
+                cache_path = os.path.join(efutil.export_path, 'mesh_cache')
+
+            self.mesh_cache = MeshCache(cache_path)
+
+        # Meshes read into MeshBuffers no longer need Blender data, they are
+        # encoded, compressed and written by the writer pool
+        self.writer_pool = None
+        self.pending_writes = []
+        self.failed_writes = []
+
+        if engine.background_writing and engine.mesh_writer == 'numpy':
+            try:
+                workers = multiprocessing.cpu_count()
+
+            except NotImplementedError:
+                workers = 1
+
+            self.writer_pool = ThreadPoolExecutor(max_workers=workers)
+            self.max_pending_writes = 2 * workers
+
         from ..outputs.pure_api import PYMTS_AVAILABLE
 
         if PYMTS_AVAILABLE:
             from ..outputs.pure_api import Serializer
 
             self.serializer = Serializer()
-            self.fast_export = True
+
+        # Automatic precision follows the Mitsuba build, so that the python extension writes the meshes
+        self.mesh_precision = engine.mesh_precision
+
+        if self.mesh_precision == 'auto':
+            self.mesh_precision = self.serializer.precision if self.serializer is not None else 'double'
+
+        self.fast_export = self.serializer is not None and self.serializer.precision == self.mesh_precision
+
+    def openContainer(self, file_path, use_serializer):
+        if use_serializer:
+            return self.serializer.open(file_path)
+
+        return SerializedContainer(file_path, self.compressor)
+
+    def frameContainer(self, sc_fr):
+        """
+        Serialized file shared by all static meshes of a frame subfolder.
+        """
+
+        if sc_fr not in self.FrameContainers:
+            self.FrameContainers[sc_fr] = self.openContainer('/'.join([sc_fr, 'meshes.serialized']), self.fast_export)
+
+        return self.FrameContainers[sc_fr]
+
+    def closeContainers(self):
+        for container in self.FrameContainers.values():
+            container.close()
+            MtsLog('Mesh container written: %s (%d meshes)' % (container.path, container.shape_count))
+
+        self.FrameContainers = {}
+
+    def staticStore(self, scene):
+        """
+        Mesh store shared by all frames of a scene, for meshes that do not deform.
+        """
+
+        path = get_static_subdir(scene)
+
+        if path not in self.StaticStores:
+            self.StaticStores[path] = MeshCache(path)
+
+        return self.StaticStores[path]
+
+    def meshStores(self):
+        stores = list(self.StaticStores.values())
+
+        if self.mesh_cache is not None:
+            stores.insert(0, self.mesh_cache)
+
+        return stores
+
+    def cacheStats(self):
+        return [cache.stats() for cache in (self.ExportedObjects, self.ExportedMeshes, self.ExportedFiles, self.Tessellations)]
+
+    def writeInBackground(self, obj_name, writes):
+        """
+        Run the file writes of an object on the writer pool. The number of
+        queued objects is bounded, as each one holds its mesh buffers.
+        """
+
+        def run_writes():
+            failed = []
+
+            for filename, write in writes:
+                try:
+                    write()
+
+                except Exception as err:
+                    MtsLog('Mesh export failed, skipping this mesh: %s: %s' % (filename, err))
+                    failed.append(filename)
+
+            return failed
+
+        self.pending_writes.append((obj_name, self.writer_pool.submit(run_writes)))
+
+        while len(self.pending_writes) > self.max_pending_writes:
+            self.joinWrite(*self.pending_writes.pop(0))
+
+    def joinWrite(self, obj_name, future):
+        self.failed_writes.extend(future.result())
+
+    def joinWriters(self):
+        """
+        Wait for all background mesh writes, must be called before the scene is configured.
+        The shapes of the meshes are already in the scene, those of failed writes are removed.
+        """
+
+        try:
+            for obj_name, future in self.pending_writes:
+                self.joinWrite(obj_name, future)
+
+        finally:
+            self.pending_writes = []
+
+            if self.writer_pool is not None:
+                self.writer_pool.shutdown()
+                self.writer_pool = None
+
+        if self.failed_writes:
+            self.dropShapes(self.failed_writes)
+            self.failed_writes = []
+
+    def dropShapes(self, filenames):
+        """
+        Remove the shapes using any of the mesh files from the scene, along
+        with the instances of the shapegroups containing them.
+        """
+
+        filenames = set(filenames)
+        dropped_ids = set()
+
+        def uses_files(element):
+            for key, value in element.items():
+                if isinstance(value, dict):
+                    if (value.get('type') == 'ref' and value.get('id') in dropped_ids) or uses_files(value):
+                        return True
+
+                elif key == 'filename' and value in filenames:
+                    return True
+
+            return False
+
+        scene_data = self.export_ctx.scene_data
+        dropped = 0
+
+        # shapegroups are added to the scene before their instances
+        for name, element in list(scene_data.items()):
+            if isinstance(element, dict) and uses_files(element):
+                del scene_data[name]
+                dropped += 1
+
+                if 'id' in element:
+                    dropped_ids.add(element['id'])
+
+        MtsLog('Shapes removed from the scene: %d, mesh files missing: %s' % (dropped, ', '.join(sorted(filenames))))
 
     def buildMesh(self, obj, seq=0.0):
         """
@@ -97,8 +339,10 @@ class GeometryExporter:
         # Using a cache on object massively speeds up dupli instance export
         obj_cache_key = (self.geometry_scene, obj)
 
-        if self.ExportedObjects.have(obj_cache_key):
-            return self.ExportedObjects.get(obj_cache_key)
+        mesh_definitions = self.ExportedObjects.get(obj_cache_key)
+
+        if mesh_definitions is not None:
+            return mesh_definitions
 
         mesh_definitions = self.writeMesh(obj, seq=seq)
 
@@ -128,24 +372,196 @@ class GeometryExporter:
 
         try:
             mesh_definitions = []
-            mesh = obj.to_mesh(self.geometry_scene, True, 'RENDER')
+            ffaces_mats = None
+            mesh_buffers = None
+            submeshes = None
+
+            # Render meshes of curve, surface and text objects that don't change
+            # are tessellated once and kept until the end of the export or batch
+            tess_key = tessellation_key(obj) if not self.is_preview else None
+            tessellation = self.Tessellations.get(obj, tess_key)
+
+            # Meshes of motion samples recorded ahead of the export are owned by the recorder
+            sampled_mesh = self.sampled_meshes.get(obj)
+
+            if tessellation is not None:
+                mesh, mesh_buffers = tessellation
+
+            elif sampled_mesh is not None:
+                mesh = sampled_mesh
+
+            else:
+                mesh = obj.to_mesh(self.geometry_scene, True, 'RENDER')
 
             if mesh is None:
                 raise UnexportableObjectException('Cannot create render/export mesh')
 
-            # collate faces by mat index
-            ffaces_mats = {}
-            mesh_faces = mesh.tessfaces
+            precision = obj.data.mitsuba_mesh.precision
+
+            if precision == 'global':
+                precision = self.mesh_precision
+
+            # The python extension writes meshes in the precision Mitsuba was built with,
+            # other meshes are written by the addon
+            use_serializer = file_format == 'serialized' and self.serializer is not None and \
+                self.serializer.precision == precision
+
+            # Huge serialized meshes are encoded in chunks of faces to stay below the memory limit
+            memory_limit = self.visibility_scene.mitsuba_engine.mesh_memory_limit * 1024 * 1024
+            use_streaming = file_format == 'serialized' and memory_limit > 0 and \
+                len(mesh.tessfaces) * STREAM_BYTES_PER_FACE > memory_limit
+
+            if use_streaming:
+                use_serializer = False
+
+            # Mitsuba computes the normals of faceNormals meshes, the vertex normals are not needed
+            face_normals = obj.data.mitsuba_mesh.normals == 'facenormals'
+
+            use_buffers = (self.visibility_scene.mitsuba_engine.mesh_writer == 'numpy' or use_streaming) and not use_serializer
+
+            # Time samples of a deforming mesh reuse the topology of the first sample,
+            # only the vertex positions and normals are read again
+            deform_key = None
+
+            if use_buffers and not use_streaming and not self.is_preview and \
+                    self.visibility_scene.mitsuba_engine.deformation_topology and is_deforming(obj):
+                deform_key = (self.geometry_scene, obj, base_frame, face_normals)
+                topology = self.DeformTopologies.get(deform_key)
+
+                if topology is not None:
+                    submeshes = topology.deform(mesh)
+
+            if submeshes is not None:
+                material_indices = list(submeshes.keys())
+
+            elif use_buffers:
+                # read the mesh once, all material parts are split from it
+                # in a single pass when the first one needs to be written,
+                # on the writer pool for background writes
+                if mesh_buffers is None:
+                    mesh_buffers = MeshBuffers(mesh)
+
+                material_indices = mesh_buffers.material_indices()
+
+                # the first time sample of a deforming mesh is split here, as
+                # the later samples need its topology
+                if deform_key is not None:
+                    topology = DeformationTopology(mesh_buffers, face_normals)
+                    self.DeformTopologies[deform_key] = topology
+                    submeshes = topology.submeshes
+
+            else:
+                # collate faces by mat index
+                ffaces_mats = {}
+                mesh_faces = mesh.tessfaces
+
+                for f in mesh_faces:
+                    mi = f.material_index
+
+                    if mi not in ffaces_mats.keys():
+                        ffaces_mats[mi] = []
+
+                    ffaces_mats[mi].append(f)
+
+                material_indices = ffaces_mats.keys()
+
+            parts = None
+
+            if use_buffers and not use_streaming:
+                parts = MaterialParts(mesh_buffers, face_normals, submeshes)
+
+            if use_serializer:
+                writer = 'serializer'
+
+            elif use_streaming:
+                writer = 'streamed'
+
+            else:
+                writer = self.visibility_scene.mitsuba_engine.mesh_writer
+
+            mesh_digest = None
+
+            # Identical geometry from separate mesh datablocks is exported once
+            # and instanced, the evaluated mesh data is compared by its digest
+            auto_instancing = self.visibility_scene.mitsuba_engine.auto_instancing and \
+                not self.is_preview and not is_deforming(obj)
+
+            # Mesh files are shared through the persistent mesh cache, or through the
+            # static folder of the scene for meshes that don't change between frames
+            mesh_store = None
+
+            if not self.is_preview:
+                if self.mesh_cache is not None:
+                    mesh_store = self.mesh_cache
+
+                elif self.share_static_meshes and not is_deforming(obj):
+                    mesh_store = self.staticStore(self.geometry_scene)
 
-            for f in mesh_faces:
-                mi = f.material_index
+            def geometry_digest():
+                # the mesh is read and hashed by the first lookup needing its digest
+                nonlocal mesh_buffers, mesh_digest
 
-                if mi not in ffaces_mats.keys():
-                    ffaces_mats[mi] = []
+                if mesh_digest is None:
+                    if mesh_buffers is None:
+                        mesh_buffers = MeshBuffers(mesh)
 
-                ffaces_mats[mi].append(f)
+                    mesh_digest = mesh_buffers.digest()
 
-            material_indices = ffaces_mats.keys()
+                return mesh_digest
+
+            # Background writes outlive this call, the buffers they read are passed in
+            def write_part(file_path, mesh_name, i, mesh_buffers, parts):
+                if use_streaming:
+                    write_serialized_streamed(file_path, mesh_name, mesh_buffers, mesh_buffers.material_faces(i), self.compressor, precision, memory_limit)
+
+                elif use_buffers:
+                    if file_format == 'ply':
+                        write_ply_submesh(file_path, mesh_name, parts[i])
+
+                    else:
+                        write_serialized_submesh(file_path, mesh_name, parts[i], self.compressor, precision)
+
+                elif file_format == 'ply':
+                    write_ply_mesh(file_path, mesh_name, mesh, ffaces_mats[i])
+
+                elif use_serializer:
+                    self.serializer.serialize(file_path, mesh_name, mesh, i)
+
+                else:
+                    write_serialized_mesh(file_path, mesh_name, mesh, ffaces_mats[i], self.compressor, precision)
+
+            def write_file(file_path, mesh_name, i, mesh_buffers, parts):
+                try:
+                    write_part(file_path, mesh_name, i, mesh_buffers, parts)
+
+                except:
+                    # the scene must not reference a partially written file
+                    if os.path.exists(file_path):
+                        os.remove(file_path)
+
+                    raise
+
+                MtsLog('Mesh file written: %s' % (file_path))
+
+            def store_file(cache_key, mesh_name, i, mesh_buffers, parts):
+                file_path = mesh_store.store(cache_key, file_format, lambda path: write_part(path, mesh_name, i, mesh_buffers, parts))
+                MtsLog('Mesh file written: %s' % (file_path))
+
+            # Separate files of meshes read into buffers are written in the background,
+            # writes using Blender data must run on the main thread
+            background = use_buffers and self.writer_pool is not None and not self.is_preview
+            background_writes = []
+
+            # Serialized meshes can be grouped into container files, static meshes
+            # per frame subfolder and deforming meshes per object and time sample
+            container_mode = 'none'
+            container = None
+
+            if file_format == 'serialized' and not self.is_preview:
+                container_mode = self.visibility_scene.mitsuba_engine.serialized_container
+
+                if container_mode == 'frame' and (is_deforming(obj) or use_serializer != self.fast_export):
+                    container_mode = 'object'
 
             number_of_mats = len(mesh.materials)
 
@@ -163,9 +579,27 @@ class GeometryExporter:
                     # If this mesh/mat-index combo has already been processed, get it from the cache
                     mesh_cache_key = (self.geometry_scene, obj.data, i, seq)
 
-                    if self.allowShapeInstancing(obj, i) and self.ExportedMeshes.have(mesh_cache_key):
-                        mesh_definitions.append(self.ExportedMeshes.get(mesh_cache_key))
-                        continue
+                    if self.allowShapeInstancing(obj, i):
+                        mesh_definition = self.ExportedMeshes.get(mesh_cache_key)
+
+                        if mesh_definition is not None:
+                            mesh_definitions.append(mesh_definition)
+                            continue
+
+                    geometry_key = None
+
+                    if auto_instancing:
+                        geometry_key = self.geometryInstanceKey(obj, i, mesh, geometry_digest, face_normals, file_format, precision, writer)
+
+                        mesh_definition = self.ExportedMeshes.get(geometry_key) if geometry_key is not None else None
+
+                        if mesh_definition is None and geometry_key in self.GeometryParts:
+                            mesh_definition = self.promoteGeometryPart(geometry_key)
+
+                        if mesh_definition is not None:
+                            MtsLog('Instancing identical mesh: %s' % obj.data.name)
+                            mesh_definitions.append(mesh_definition)
+                            continue
 
                     # Put files in frame-numbered subfolders to avoid
                     # clobbering when rendering animations
@@ -184,36 +618,80 @@ class GeometryExporter:
                     while self.ExportedFiles.have(file_path):
                         mesh_name, file_path = make_filename()
 
-                    self.ExportedFiles.add(file_path, None)
+                    self.ExportedFiles.add(file_path, None, evictable=False)
+
+                    shape_index = None
+                    write = None
+
+                    if container_mode != 'none':
+                        if container_mode == 'frame':
+                            container = self.frameContainer(sc_fr)
+
+                        elif container is None:
+                            container_name = '%s_%04d_%f' % (obj.data.name, self.ExportedFiles.serial((obj.data, seq)), seq)
+                            container = self.openContainer('/'.join([sc_fr, '%s.serialized' % bpy.path.clean_name(container_name)]), use_serializer)
+
+                        if use_streaming:
+                            shape_index = container.add_streamed(mesh_name, mesh_buffers, mesh_buffers.material_faces(i), precision, memory_limit)
 
-                    # skip writing the file if the box is checked
-                    skip_exporting = obj in self.KnownExportedObjects and not obj in self.KnownModifiedObjects
+                        elif use_buffers:
+                            shape_index = container.add_submesh(mesh_name, parts[i], precision)
 
-                    if not os.path.exists(file_path) or not (self.visibility_scene.mitsuba_engine.partial_export and skip_exporting):
+                        elif use_serializer:
+                            shape_index = container.add_mesh(mesh_name, mesh, i)
 
-                        GeometryExporter.NewExportedObjects.add(obj)
+                        else:
+                            shape_index = container.add_mesh(mesh_name, mesh, ffaces_mats[i], precision)
+
+                        file_path = container.path
 
-                        if file_format == 'ply':
-                            write_ply_mesh(file_path, mesh_name, mesh, ffaces_mats[i])
+                    elif mesh_store is not None:
+                        if deform_key is not None:
+                            # samples of deforming meshes are keyed by their deformed
+                            # part, the topology is not read again
+                            part_digest = submeshes[i].digest()
 
                         else:
-                            if self.fast_export:
-                                self.serializer.serialize(file_path, mesh_name, mesh, i)
+                            part_digest = geometry_digest()
 
-                            else:
-                                write_serialized_mesh(file_path, mesh_name, mesh, ffaces_mats[i])
+                        cache_key = mesh_store.key(part_digest, i, file_format, precision, writer, face_normals, deform_key is not None)
+                        cached_path = mesh_store.get(cache_key, file_format)
 
-                        MtsLog('Mesh file written: %s' % (file_path))
+                        if cached_path is not None:
+                            MtsLog('Reusing cached mesh: %s' % cached_path)
+                            file_path = cached_path
+
+                        else:
+                            file_path = mesh_store.file_path(cache_key, file_format)
+                            write = functools.partial(store_file, cache_key, mesh_name, i)
 
                     else:
-                        MtsLog('Skipping already exported mesh: %s' % mesh_name)
+                        write = functools.partial(write_file, file_path, mesh_name, i)
+
+                    filename = self.export_ctx.get_export_path(file_path)
+
+                    if write is not None:
+                        write = functools.partial(write, mesh_buffers, parts)
+
+                        if background:
+                            background_writes.append((filename, write))
+
+                        else:
+                            try:
+                                write()
+
+                            except Exception as err:
+                                raise InvalidGeometryException('%s: %s' % (filename, err))
 
                     shape_params = {
-                        'filename': self.export_ctx.get_export_path(file_path),
+                        'filename': filename,
                         'doubleSided': mesh.show_double_sided
                     }
 
-                    if obj.data.mitsuba_mesh.normals == 'facenormals':
+                    if shape_index is not None:
+                        shape_params.update({'shapeIndex': shape_index})
+
+                    if face_normals:
                         shape_params.update({'faceNormals': 'true'})
 
                     mesh_definition = (
@@ -235,15 +713,33 @@ class GeometryExporter:
                             instance_params,
                             seq
                         )
+
                         self.ExportedMeshes.add(mesh_cache_key, mesh_definition)
 
+                        if geometry_key is not None:
+                            self.ExportedMeshes.add(geometry_key, mesh_definition)
+
+                    elif geometry_key is not None:
+                        # a plain shape until another object has the same geometry
+                        self.GeometryParts[geometry_key] = (obj, mesh_definitions, len(mesh_definitions))
+
                     mesh_definitions.append(mesh_definition)
 
                 except InvalidGeometryException as err:
                     MtsLog('Mesh export failed, skipping this mesh: %s' % err)
 
-            del ffaces_mats
-            bpy.data.meshes.remove(mesh)
+            if container_mode == 'object' and container is not None:
+                container.close()
+                MtsLog('Mesh container written: %s (%d meshes)' % (container.path, container.shape_count))
+
+            if background_writes:
+                self.writeInBackground(obj.name, background_writes)
+
+            if tess_key is not None:
+                self.Tessellations.add(tess_key, mesh, mesh_buffers)
+
+            elif sampled_mesh is None:
+                bpy.data.meshes.remove(mesh)
 
         except UnexportableObjectException as err:
             MtsLog('Object export failed, skipping this object: %s' % err)
@@ -325,6 +821,47 @@ class GeometryExporter:
         else:
             return not self.is_preview
 
+    def geometryInstanceKey(self, obj, mat_index, mesh, mesh_digest, *settings):
+        """
+        Cache key of a mesh part, shared by all objects with the same evaluated
+        geometry, material and export settings. None if the material can't
+        be used on instances, mesh_digest is then not called.
+        """
+
+        try:
+            ob_mat = obj.material_slots[mat_index].material
+
+        except IndexError:
+            ob_mat = None
+
+        if ob_mat and not self.allowMaterialInstancing(ob_mat):
+            return None
+
+        return (self.geometry_scene, 'geometry', mesh_digest(), mat_index, ob_mat, mesh.show_double_sided) + settings
+
+    def promoteGeometryPart(self, geometry_key):
+        """
+        Turn the plain shape of the first mesh part with this geometry into a
+        shapegroup instance, once a second object uses the same geometry.
+        The mesh definitions of the first object are updated in place.
+        """
+
+        obj, mesh_definitions, index = self.GeometryParts.pop(geometry_key)
+        me_name, me_mat_index, me_shape_type, me_shape_params, me_seq = mesh_definitions[index]
+
+        mesh_definition = (
+            me_name,
+            me_mat_index,
+            'instance',
+            self.exportShapeGroup(obj, mesh_definitions[index]),
+            me_seq
+        )
+
+        mesh_definitions[index] = mesh_definition
+        self.ExportedMeshes.add(geometry_key, mesh_definition)
+
+        return mesh_definition
+
     def exportShapeMaterial(self, obj, mat_index):
         try:
             ob_mat = obj.material_slots[mat_index].material
@@ -465,56 +1002,155 @@ class GeometryExporter:
 
                 self.export_ctx.data_add(deformable)
 
-    def BSpline(self, points, dimension, degree, u):
-        controlpoints = []
+    def allowInstanceTable(self, instance):
+        """
+        Static instances referencing only shapegroups can be exported in bulk.
+        """
+
+        return instance.mesh is not None and len(instance.mesh) == 1 and len(instance.mesh[0]) > 0 and \
+            all(mesh_def[2] == 'instance' for mesh_def in instance.mesh[0])
+
+    def exportInstanceTable(self, instances):
+        """
+        Export the shapegroup instances of a list of (name, instance) in bulk.
+        The motion matrices of all instances are gathered into one array,
+        checked for singularity and linear motion and converted to Mitsuba
+        space at once.
+        """
 
-        def Basispolynom(controlpoints, i, u, degree):
-            if degree == 0:
-                temp = 0
+        if not instances:
+            return
 
-                if (controlpoints[i] <= u) and (u < controlpoints[i + 1]):
-                    temp = 1
+        counts = numpy.array([len(instance.motion) for name, instance in instances], dtype=numpy.int64)
+        starts = numpy.cumsum(counts) - counts
+        matrices = numpy.array([m for name, instance in instances for (t, m) in instance.motion], dtype=numpy.float64).reshape((-1, 4, 4))
 
-            else:
-                N0 = Basispolynom(controlpoints, i, u, degree - 1)
-                N1 = Basispolynom(controlpoints, i + 1, u, degree - 1)
+        # Let's test if matrix is singular, don't export singular matrix
+        singular = numpy.linalg.det(matrices) == 0
+        linear = linear_motions([[t for (t, m) in instance.motion] for name, instance in instances], matrices, starts)
+        converted = self.export_ctx.convert_matrices(matrices).tolist()
 
-                if N0 == 0:
-                    sum1 = 0
+        for n, (name, instance) in enumerate(instances):
+            if counts[n] == 0:
+                continue
 
-                else:
-                    sum1 = (u - controlpoints[i]) / (controlpoints[i + degree] - controlpoints[i]) * N0
+            start = int(starts[n])
+            singular_times = [t for k, (t, m) in enumerate(instance.motion) if singular[start + k]]
 
-                if N1 == 0:
-                    sum2 = 0
+            if singular_times:
+                MtsLog('WARNING: skipping export of singular matrix in object "%s" - "%s" - %f!'
+                        % (name, instance.mesh[0][0][0], singular_times[0]))
+                continue
 
-                else:
-                    sum2 = (controlpoints[i + 1 + degree] - u) / (controlpoints[i + 1 + degree] - controlpoints[i + 1]) * N1
+            motion = [(t, converted[start + k]) for k, (t, m) in enumerate(instance.motion)]
+
+            if linear[n]:
+                motion = [motion[0], motion[-1]]
+
+            to_world = self.export_ctx.animated_transform_list(motion, simplify=False)
+
+            for me_name, me_mat_index, me_shape_type, me_shape_params, me_seq in instance.mesh[0]:
+                shape = {
+                    'type': me_shape_type,
+                    'id': '%s_%s' % (name, me_name),
+                    'toWorld': to_world,
+                }
+                shape.update(me_shape_params)
+                shape.pop('doubleSided', None)
+
+                self.export_ctx.data_add(shape)
+
+    def exportParticleInstances(self, instance, name):
+        """
+        Export the instances of a ParticleInstance. The particle matrices of
+        all time samples are converted to Mitsuba space at once.
+        """
+
+        samples = len(instance.motion)
+        count = len(instance.motion[0][1][0])
+
+        if count == 0 or not instance.mesh:
+            return
+
+        times = [t for t, particles in instance.motion]
+        matrices = numpy.concatenate([m for t, (m, visible) in instance.motion]).reshape((-1, 4, 4))
+        visible = numpy.array([v for t, (m, v) in instance.motion], dtype=numpy.bool_).reshape((samples, count))
 
-                temp = sum1 + sum2
+        # particles visible at the frame time are instanced, their motion
+        # uses the samples at which they are visible
+        exported = visible[0].copy()
 
-            return temp
+        # particles with a zero size can't be instanced
+        singular = (numpy.linalg.det(matrices) == 0).reshape((samples, count))
+        exported &= ~(singular & visible).any(axis=0)
 
-        for i in range(len(points) + degree + 1):
-            if i <= degree:
-                controlpoints.append(0)
+        # only the first and last samples of particles visible and moving
+        # linearly during the whole shutter time are kept
+        linear = numpy.zeros(count, dtype=numpy.bool_)
 
-            elif i >= len(points):
-                controlpoints.append(len(points) - degree)
+        if samples > 2:
+            checked = numpy.flatnonzero(exported & visible.all(axis=0))
+            motions = matrices.reshape((samples, count, 4, 4))
+
+            for start in range(0, len(checked), PARTICLE_CHUNK):
+                chunk = checked[start:start + PARTICLE_CHUNK]
+                linear[chunk] = interpolated_fit(numpy.array(times), motions[:, chunk].transpose((1, 0, 2, 3)))
+
+        converted = self.export_ctx.convert_matrices(matrices).reshape((samples, count, 16))
+
+        for p in numpy.flatnonzero(exported).tolist():
+            if linear[p]:
+                keys = [0, samples - 1]
 
             else:
-                controlpoints.append(i - degree)
+                keys = [k for k in range(samples) if visible[k, p]]
+
+            to_world = self.export_ctx.animated_transform_list(
+                [(times[k], converted[k, p].tolist()) for k in keys], simplify=False
+            )
+
+            for me_name, me_mat_index, me_shape_type, me_shape_params, me_seq in instance.mesh[0]:
+                shape = {
+                    'type': me_shape_type,
+                    'id': '%s_%s_%d' % (name, me_name, p),
+                    'toWorld': to_world,
+                }
+                shape.update(me_shape_params)
+                shape.pop('doubleSided', None)
 
-        if dimension == 2:
-            temp = mathutils.Vector((0.0, 0.0))
+                self.export_ctx.data_add(shape)
 
-        elif dimension == 3:
-            temp = mathutils.Vector((0.0, 0.0, 0.0))
+        MtsLog('Particle system exported: %s (%d instances)' % (name, int(exported.sum())))
+
+    def hairStrands(self, obj, psys, steps, num_strands, det):
+        """
+        Gather the points of all hair strands in object space.
+        Returns (points, strand_lengths) arrays.
+        """
+
+        # co_hair is the only access to the render paths of children,
+        # the points are collected into one array and processed in bulk
+        co = numpy.empty((num_strands, steps + 1, 3), dtype=numpy.float64)
+
+        for pindex in range(num_strands):
+            det.exported_objects += 1
+
+            for step in range(0, steps + 1):
+                co[pindex, step] = psys.co_hair(obj, pindex, step)
 
-        for i in range(len(points)):
-            temp = temp + Basispolynom(controlpoints, i, u, degree) * points[i]
+        # points at the origin are unused path steps
+        valid = numpy.any(co != 0.0, axis=2)
 
-        return temp
+        transform = numpy.array(obj.matrix_world.inverted())
+        co = numpy.dot(co, transform[:3, :3].T) + transform[:3, 3]
+
+        strand_lengths = valid.sum(axis=1)
+        points = co[valid]
+
+        if psys.settings.use_hair_bspline:
+            points, strand_lengths = resample_bspline(points, strand_lengths, 2, 2 ** psys.settings.render_step)
+
+        return points, strand_lengths
 
     def handler_Duplis_PATH(self, obj, psys):
         if not psys.settings.type == 'HAIR':
@@ -543,40 +1179,13 @@ class GeometryExporter:
         hair_filename = '%s.hair' % bpy.path.clean_name(partsys_name)
         hair_file_path = '/'.join([sc_fr, hair_filename])
 
-        hair_file = open(hair_file_path, 'w')
-
-        transform = obj.matrix_world.inverted()
-
-        for pindex in range(num_parents + num_children):
-            det.exported_objects += 1
-            points = []
-
-            for step in range(0, steps + 1):
-                co = psys.co_hair(obj, pindex, step)
-                if not co.length_squared == 0:
-                    points.append(transform * co)
+        points, strand_lengths = self.hairStrands(obj, psys, steps, num_parents + num_children, det)
 
-            if psys.settings.use_hair_bspline:
-                temp = []
-                degree = 2
-                dimension = 3
+        if psys.settings.mitsuba_hair.hair_format == 'binary':
+            write_hair_binary(hair_file_path, points, strand_lengths)
 
-                for i in range(math.trunc(math.pow(2, psys.settings.render_step))):
-                    if i > 0:
-                        u = i * (len(points) - degree) / math.trunc(math.pow(2, psys.settings.render_step) - 1) - 0.0000000000001
-
-                    else:
-                        u = i * (len(points) - degree) / math.trunc(math.pow(2, psys.settings.render_step) - 1)
-                    temp.append(self.BSpline(points, dimension, degree, u))
-
-                points = temp
-
-            for p in points:
-                hair_file.write('%f %f %f\n' % (p[0], p[1], p[2]))
-
-            hair_file.write('\n')
-
-        hair_file.close()
+        else:
+            write_hair_ascii(hair_file_path, points, strand_lengths)
 
         psys.set_resolution(self.geometry_scene, obj, 'PREVIEW')
         det.stop()
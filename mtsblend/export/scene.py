@@ -22,7 +22,13 @@
 # ***** END GPL LICENSE BLOCK *****
 
 # System Libs
+from collections import OrderedDict
+
 import os
+import math
+
+# Blender Libs
+import bpy
 
 # Extensions_Framework Libs
 from ..extensions_framework import util as efutil
@@ -32,9 +38,17 @@ from ..export.environment import get_environment_trafo, export_world_environment
 from ..export.cameras import export_camera_instance
 from ..export.lamps import export_lamp_instance
 from ..export.materials import ExportedMaterials, ExportedTextures
-from ..export.geometry import GeometryExporter
-from ..export import Instance, is_object_visible, is_light, is_mesh, is_deforming, object_render_hide, object_render_hide_duplis
+from ..export.geometry import GeometryExporter, TessellationCache
+from ..export import Instance, ParticleInstance, VisibilityTable, is_light, is_mesh, is_deforming
+from ..export import is_bulk_particle_system, particle_matrices
 from ..outputs import MtsManager, MtsLog
+from ..outputs.file_api import FileExportContext, get_plugin_tag
+
+# plugins written to the include files of a batch export, when they are the same in every frame.
+# Mitsuba parses included files with the named objects of the including file, so
+# ids defined by an include can be referenced after it. The integrator is not
+# moved, it is not reliably taken over from the nested scene of an include.
+SHARED_PLUGINS = {'bsdf', 'texture', 'subsurface', 'medium', 'phase'}
 
 
 def get_subframes(segs, shutter):
@@ -57,6 +71,80 @@ def get_obj_unique_id(b_ob, duplicator):
     return (obj, unique_id)
 
 
+def is_shared_element(element):
+    return isinstance(element, dict) and (element.get('type') == 'shapegroup' or get_plugin_tag(element.get('type')) in SHARED_PLUGINS)
+
+
+def element_refs(element):
+    '''
+    element             scene element dict
+
+    Returns the set of ids referenced by the element and its children
+    '''
+
+    refs = set()
+
+    for value in element.values():
+        if isinstance(value, dict):
+            if value.get('type') == 'ref':
+                refs.add(value.get('id'))
+
+            else:
+                refs |= element_refs(value)
+
+    return refs
+
+
+def element_id(name, element):
+    return element.get('id', name)
+
+
+def write_scene_file(scene, path, elements, included_ids=()):
+    '''
+    scene               bpy.types.Scene
+    path                str file path
+    elements            list of (name, element)
+    included_ids        ids defined by files included before this one,
+                        references to them are written as usual
+
+    Write scene elements as a standalone Mitsuba scene file, to be included
+    by other scene files.
+    '''
+
+    export_ctx = FileExportContext()
+    export_ctx.set_filename(scene, path)
+    export_ctx.exported_ids.update(included_ids)
+    export_ctx.scene_data.update(elements)
+    export_ctx.configure()
+
+
+class DupliRecord:
+    """
+    Copy of a dupli list entry, kept after the dupli list is freed
+    """
+
+    def __init__(self, b_dup):
+        self.object = b_dup.object
+        self.persistent_id = tuple(b_dup.persistent_id)
+        self.matrix = b_dup.matrix.copy()
+        self.hide = b_dup.hide
+        self.type = b_dup.type
+
+
+class MotionSample:
+    """
+    State of the scene at one motion sample time, recorded ahead of the
+    export of the frame it belongs to
+    """
+
+    def __init__(self):
+        self.camera = None
+        self.environment = None
+        self.objects = {}       # scene name: list of (b_ob, duplicator, trafo, hide_mesh)
+        self.particles = {}     # particle system id: (particle matrices, visibility)
+        self.meshes = {}        # deforming object: render mesh
+
+
 class SceneExporterProperties:
     """
     Mimics the properties member contained within EXPORT_OT_Mitsuba operator
@@ -74,14 +162,32 @@ class SceneExporter:
     properties = SceneExporterProperties()
     shape_instances = {}
 
+    # VisibilityTable of the scene, built by the first lookup of an export or
+    # of a motion sample recorded ahead of it, as the layers may be animated
+    visibility = None
+
+    # frame: (path, elements) of the elements moved out of the frame scene file by a batch export
+    shared_elements = None
+    shared_filename = ''
+
+    # TessellationCache kept for all the frames of a batch export
+    tessellations = None
+
     def set_properties(self, properties):
         self.properties = properties
         return self
 
     def set_scene(self, scene):
         self.scene = scene
+        self.visibility = None
         return self
 
+    def visibility_table(self):
+        if self.visibility is None:
+            self.visibility = VisibilityTable(self.scene)
+
+        return self.visibility
+
     def set_report(self, report):
         self.report = report
         return self
@@ -162,13 +268,141 @@ class SceneExporter:
                                 )],
                             )
 
-    # Create two lists, one of data blocks to export and one of instances to export
-    # Collect and store motion blur transformation data in a pre-process.
-    # More efficient, and avoids too many frame updates in blender.
-    def cache_motion(self, scene):
-        origframe = scene.frame_current
+    def bulk_particle_systems(self, b_ob):
+        '''
+        Returns (skipped, bulk): the set of names of the object and group
+        particle systems of b_ob that aren't exported at all, and the list
+        of the systems that can be exported in bulk.
+        '''
+
+        skipped = set()
+        bulk = []
+
+        for psys in b_ob.particle_systems:
+            settings = psys.settings
+
+            if settings.render_type not in {'OBJECT', 'GROUP'}:
+                continue
+
+            # systems not exported at all don't go through the dupli list either
+            if not self.scene.mitsuba_engine.export_particles or \
+                    any(mod.type == 'PARTICLE_SYSTEM' and mod.particle_system == psys and not mod.show_render for mod in b_ob.modifiers):
+                skipped.add(psys.name)
+                continue
+
+            if not is_bulk_particle_system(psys):
+                continue
+
+            # hidden dupli objects are skipped as in the dupli list
+            (hide_obj, hide_mesh) = self.visibility_table().render_hide(settings.dupli_object, False, False)
+
+            if settings.dupli_object.hide_render or hide_obj or hide_mesh:
+                skipped.add(psys.name)
+                continue
+
+            bulk.append(psys)
+
+        return skipped, bulk
+
+    def sync_particles(self, instances, b_ob, seq=0.0):
+        '''
+        Sync the object particle systems of b_ob in bulk, instead of through
+        its dupli list.
+
+        Returns the set of names of the particle systems handled
+        '''
+
+        handled, bulk = self.bulk_particle_systems(b_ob)
+
+        for psys in bulk:
+            dupli_obj = psys.settings.dupli_object
+            psys_id = '%s_%s' % (b_ob.name, psys.name)
+            particles = particle_matrices(self.GE.geometry_scene, psys, dupli_obj)
+
+            if psys_id in instances:
+                instances[psys_id].append_motion(particles, seq)
+
+            else:
+                self.GE.objects_used_as_duplis.add(dupli_obj)
+                mesh = self.GE.buildMesh(dupli_obj, seq=seq)
+
+                # meshes that can't be shapegroups are exported per dupli
+                if not mesh or any(mesh_def[2] != 'instance' for mesh_def in mesh):
+                    continue
+
+                instances[psys_id] = ParticleInstance(b_ob, psys, particles, mesh)
+
+            handled.add(psys.name)
+
+        return handled
+
+    def sync_objects(self, scene, scene_obs, sync, sync_particles):
+        '''
+        Walk the given objects and their duplis as they are rendered.
+
+        sync                function (b_ob, duplicator, trafo, hide_mesh)
+        sync_particles      function (b_ob) syncing particle systems in bulk,
+                            returns the set of names of the systems handled
+        '''
+
+        visibility = self.visibility_table()
+
+        for b_ob in scene_obs:
+            if scene.mitsuba_testing.object_analysis:
+                MtsLog('Analysing object %s : %s' % (b_ob, b_ob.type))
+
+            if b_ob.is_duplicator and not visibility.hide_duplis(b_ob):
+                if scene.mitsuba_testing.object_analysis:
+                    MtsLog("Dupli object", b_ob.name)
+
+                bulk_psys = sync_particles(b_ob)
+
+                # the dupli list is only needed for duplis not exported in bulk
+                use_dupli_list = b_ob.dupli_type != 'NONE' or any(
+                    psys.name not in bulk_psys for psys in b_ob.particle_systems
+                    if psys.settings.render_type in {'OBJECT', 'GROUP'})
+
+                if use_dupli_list:
+                    # dupli objects
+                    b_ob.dupli_list_create(scene, 'RENDER')
+
+                    for b_dup in b_ob.dupli_list:
+                        psys = getattr(b_dup, 'particle_system', None)
+
+                        if psys is not None and psys.name in bulk_psys:
+                            continue
+
+                        b_dup_ob = b_dup.object
+                        dup_hide = b_dup_ob.hide_render
+                        in_dupli_group = b_dup.type == 'GROUP'
+                        (hide_obj, hide_mesh) = visibility.render_hide(b_dup_ob, False, in_dupli_group)
+
+                        if not (b_dup.hide or dup_hide or hide_obj):
+                            # /* sync object and mesh or light data */
+                            trafo = b_dup.matrix.copy()
+                            sync(b_dup, b_ob, trafo, hide_mesh)
+
+                    b_ob.dupli_list_clear()
+
+            (hide_obj, hide_mesh) = visibility.render_hide(b_ob, True, True)
+
+            if not hide_obj:
+                if scene.mitsuba_testing.object_analysis:
+                    MtsLog("Synchronizing object", b_ob.name)
+
+                # object itself
+                trafo = b_ob.matrix_world.copy()
+                sync(b_ob, None, trafo, hide_mesh)
+
+    def motion_segments(self, scene):
+        '''
+        Returns dict of scene name: dict of number of motion segments: list
+        of the visible objects using it
+        '''
+
         scene_motion_segments = scene.render.motion_blur_samples if scene.render.use_motion_blur else 0
         segs = {}
+        visibility = self.visibility_table()
         b_sce = scene
 
         while b_sce is not None:
@@ -176,10 +410,9 @@ class SceneExporter:
             # from renderable objects in the scene, and global scene settings
             segs[b_sce.name] = {}
             segs[b_sce.name][scene_motion_segments] = []
-            self.shape_instances[b_sce.name] = {}
 
             for b_ob in b_sce.objects:
-                if is_object_visible(scene, b_ob):
+                if visibility.is_visible(b_ob):
                     if scene.render.use_motion_blur and b_ob.mitsuba_object.motion_samples_override:
                         ob_segments = b_ob.mitsuba_object.motion_blur_samples
 
@@ -194,7 +427,14 @@ class SceneExporter:
 
             b_sce = b_sce.background_set
 
-        # now get a full list of subframes and the corresponding segment groups
+        return segs
+
+    def motion_subframes(self, scene, segs):
+        '''
+        Returns dict of subframe: list of numbers of motion segments sampled
+        at that subframe
+        '''
+
         subframes = {}
         for scene_segs in segs.values():
             for num_segs in scene_segs.keys():
@@ -205,6 +445,93 @@ class SceneExporter:
                     except:
                         subframes[sub] = [num_segs]
 
+        return subframes
+
+    def record_sample(self, scene, segs, seq_groups):
+        '''
+        Record the state of the scene at the current time, for the export of
+        another frame. Duplis are copied, deformed meshes are built.
+
+        Returns MotionSample
+        '''
+
+        sample = MotionSample()
+        cam = scene.camera.data
+        sample.camera = (scene.camera.matrix_world.copy(),
+            cam.ortho_scale / 2.0 if cam.type == 'ORTHO' else None)
+        sample.environment = get_environment_trafo(scene.world)
+
+        b_sce = scene
+
+        while b_sce is not None:
+            events = []
+            scene_obs = [b_ob for num_segs in seq_groups for b_ob in segs[b_sce.name].get(num_segs, [])]
+
+            def record(b_ob, duplicator, trafo, hide_mesh):
+                if duplicator is not None:
+                    b_ob = DupliRecord(b_ob)
+                    obj = b_ob.object
+
+                else:
+                    obj = b_ob
+
+                events.append((b_ob, duplicator, trafo, hide_mesh))
+
+                if not hide_mesh and is_mesh(obj) and is_deforming(obj) and obj not in sample.meshes:
+                    sample.meshes[obj] = obj.to_mesh(b_sce, True, 'RENDER')
+
+            def record_particles(b_ob):
+                handled, bulk = self.bulk_particle_systems(b_ob)
+
+                for psys in bulk:
+                    sample.particles['%s_%s' % (b_ob.name, psys.name)] = particle_matrices(b_sce, psys, psys.settings.dupli_object)
+                    handled.add(psys.name)
+
+                return handled
+
+            self.sync_objects(scene, scene_obs, record, record_particles)
+            sample.objects[b_sce.name] = events
+            b_sce = b_sce.background_set
+
+        return sample
+
+    def replay_sample(self, scene, sample, origframe, seq):
+        self.scene_camera.append_motion(sample.camera, seq)
+
+        if sample.environment is not None:
+            self.world_environment.append_motion(sample.environment, seq)
+
+        b_sce = scene
+        self.GE.sampled_meshes = sample.meshes
+
+        while b_sce is not None:
+            self.GE.geometry_scene = b_sce
+            instances = self.shape_instances[b_sce.name]
+
+            for b_ob, duplicator, trafo, hide_mesh in sample.objects.get(b_sce.name, []):
+                self.sync_object(instances, b_ob, duplicator, trafo, hide_mesh, origframe, seq)
+
+            for psys_id, particles in sample.particles.items():
+                if psys_id in instances:
+                    instances[psys_id].append_motion(particles, seq)
+
+            b_sce = b_sce.background_set
+
+        self.GE.sampled_meshes = {}
+
+    # Create two lists, one of data blocks to export and one of instances to export
+    # Collect and store motion blur transformation data in a pre-process.
+    # More efficient, and avoids too many frame updates in blender.
+    def cache_motion(self, scene, samples=None):
+        origframe = scene.frame_current
+        origsubframe = scene.frame_subframe
+        segs = self.motion_segments(scene)
+        subframes = self.motion_subframes(scene, segs)
+        frame_changed = False
+
+        for scene_name in segs.keys():
+            self.shape_instances[scene_name] = {}
+
         # the aim here is to do only a minimal number of scene updates,
         # so we go through all subframes and process objects pertaining to
         # segment groups included in the subframe
@@ -212,8 +539,17 @@ class SceneExporter:
             sub = min(subframes.keys())
             seq = sub / scene.render.motion_blur_shutter
             seq_groups = subframes.pop(sub)
-            isub, fsub = int(sub), sub - int(sub)
-            scene.frame_set(origframe + isub, fsub)
+
+            # samples recorded by export_frames are used as they are
+            if samples is not None and sub in samples:
+                self.replay_sample(scene, samples[sub], origframe, seq)
+                continue
+
+            # the scene may already be at the start of the frame
+            if sub != 0 or frame_changed or origsubframe != 0:
+                isub, fsub = int(sub), sub - int(sub)
+                scene.frame_set(origframe + isub, fsub)
+                frame_changed = True
 
             cam = scene.camera.data
             cam_trafo = (scene.camera.matrix_world.copy(),
@@ -240,48 +576,197 @@ class SceneExporter:
                     except:
                         continue
 
-                    for b_ob in scene_obs:
-                        if scene.mitsuba_testing.object_analysis:
-                            MtsLog('Analysing object %s : %s' % (b_ob, b_ob.type))
+                    self.sync_objects(
+                        scene,
+                        scene_obs,
+                        lambda b_ob, duplicator, trafo, hide_mesh: self.sync_object(instances, b_ob, duplicator, trafo, hide_mesh, origframe, seq),
+                        lambda b_ob: self.sync_particles(instances, b_ob, seq)
+                    )
 
-                        if b_ob.is_duplicator and not object_render_hide_duplis(b_ob):
-                            if scene.mitsuba_testing.object_analysis:
-                                MtsLog("Dupli object", b_ob.name)
+                b_sce = b_sce.background_set
 
-                            # dupli objects
-                            b_ob.dupli_list_create(scene, 'RENDER')
+        # the last motion samples of all deforming meshes are written
+        self.GE.DeformTopologies.clear()
 
-                            for b_dup in b_ob.dupli_list:
-                                b_dup_ob = b_dup.object
-                                dup_hide = b_dup_ob.hide_render
-                                in_dupli_group = b_dup.type == 'GROUP'
-                                (hide_obj, hide_mesh) = object_render_hide(b_dup_ob, False, in_dupli_group)
+        if frame_changed:
+            scene.frame_set(origframe, origsubframe)
 
-                                if not (b_dup.hide or dup_hide or hide_obj):
-                                    # /* sync object and mesh or light data */
-                                    trafo = b_dup.matrix.copy()
-                                    self.sync_object(instances, b_dup, b_ob, trafo, hide_mesh, origframe, seq)
+        return True
 
-                            b_ob.dupli_list_clear()
+    def export_frames(self, frames, shared_includes=False, shared_name='', frame_done=None):
+        '''
+        frames              list of frame numbers
+        shared_includes     bool, write the elements that are the same in
+                            every frame to a shared include file
+        shared_name         str name of the shared include file, defaults
+                            to the target filename with a .shared suffix
+        frame_done          function called with the frame number and the
+                            export result after each frame
+
+        Export a range of frames, planning the motion samples of all frames
+        in a single sweep, so that every sample time is evaluated once. The
+        frames are exported in reverse order: when the sweep reaches the
+        start of a frame, the later samples of its shutter interval, such as
+        the start of the next frame, were already recorded.
+
+        The recorded samples hold the render meshes of all deforming objects
+        at every subframe of a frame until the frame is exported, so the
+        memory used by deforming meshes grows with the number of motion
+        samples. mesh_memory_limit does not apply to them.
+
+        With shared_includes, materials, textures, media and shapegroups
+        are moved out of the frame scene files. Those that are the same in
+        every frame are written once to a shared file, the others to a
+        small local file per frame, and the frame scene files include both.
+        Static meshes are written to files shared by all
+        frames, so that their shapegroups are the same in every frame.
+
+        Returns dict of frame: export result
+        '''
 
-                        (hide_obj, hide_mesh) = object_render_hide(b_ob, True, True)
+        scene = self.scene
+        origframe = scene.frame_current
+        origsubframe = scene.frame_subframe
+        filename = self.properties.filename
+        base_name = filename[:-4] if filename.endswith('.xml') else filename
+        frames = sorted(set(frames))
+        results = {}
 
-                        if not hide_obj:
-                            if scene.mitsuba_testing.object_analysis:
-                                MtsLog("Synchronizing object", b_ob.name)
+        if shared_includes and self.properties.api_type == 'FILE':
+            self.shared_elements = OrderedDict()
+            self.shared_filename = os.path.join(self.properties.directory, shared_name or '%s.shared.xml' % base_name)
 
-                            # object itself
-                            trafo = b_ob.matrix_world.copy()
-                            self.sync_object(instances, b_ob, None, trafo, hide_mesh, origframe, seq)
+        # the segment groups are planned at the current frame for all frames
+        segs = self.motion_segments(scene)
+        subframes = self.motion_subframes(scene, segs)
 
-                b_sce = b_sce.background_set
+        # sample time: list of (frame, subframe, segment groups) recorded at that time
+        recordings = {}
 
-        scene.frame_set(origframe, 0)
-        return True
+        for frame in frames:
+            for sub, seq_groups in subframes.items():
+                if sub > 0:
+                    recordings.setdefault(round(frame + sub, 6), []).append((frame, sub, tuple(seq_groups)))
 
-    def export(self):
+        samples = {frame: {} for frame in frames}
+        sample_users = {}
+        self.tessellations = TessellationCache()
+
+        def free_sample(sample):
+            sample_users[id(sample)] -= 1
+
+            if sample_users[id(sample)] == 0:
+                for mesh in sample.meshes.values():
+                    bpy.data.meshes.remove(mesh)
+
+                sample.meshes = {}
+
+        try:
+            for t in sorted(set(frames) | set(recordings.keys()), reverse=True):
+                frame = int(math.floor(t))
+                scene.frame_set(frame, t - frame)
+                self.visibility = None
+                recorded = {}
+
+                for rec_frame, sub, seq_groups in recordings.get(t, []):
+                    if seq_groups not in recorded:
+                        recorded[seq_groups] = self.record_sample(scene, segs, seq_groups)
+                        sample_users[id(recorded[seq_groups])] = 0
+
+                    samples[rec_frame][sub] = recorded[seq_groups]
+                    sample_users[id(recorded[seq_groups])] += 1
+
+                if t in samples:
+                    self.properties.filename = '%s.%05d.xml' % (base_name, frame)
+
+                    results[frame] = self.export(samples[frame])
+
+                    if frame_done is not None:
+                        frame_done(frame, results[frame])
+
+                    for sample in samples.pop(frame).values():
+                        free_sample(sample)
+
+        finally:
+            for frame_samples in samples.values():
+                for sample in frame_samples.values():
+                    free_sample(sample)
+
+            # the frame files written so far include the shared and local
+            # files, which are written even if the export stops early
+            if self.shared_elements:
+                self.write_shared_elements(scene)
+
+            self.properties.filename = filename
+            self.shared_elements = None
+            self.tessellations.clear()
+            self.tessellations = None
+            scene.frame_set(origframe, origsubframe)
+
+        return results
+
+    def split_shared_elements(self, export_ctx, scene, mts_filename):
+        '''
+        Move the elements that may be shared between frames out of the frame
+        scene, which includes them from the shared and local files instead.
+        '''
+
+        local_path = '%s.local.xml' % (mts_filename[:-4] if mts_filename.endswith('.xml') else mts_filename)
+        elements = OrderedDict()
+        scene_data = OrderedDict([('type', 'scene')])
+
+        for name, element in export_ctx.scene_data.items():
+            if name != 'type' and is_shared_element(element):
+                elements[name] = element
+
+        scene_data['include_shared'] = {'type': 'include', 'filename': os.path.basename(self.shared_filename)}
+        scene_data['include_local'] = {'type': 'include', 'filename': os.path.basename(local_path)}
+
+        for name, element in export_ctx.scene_data.items():
+            if name != 'type' and name not in elements:
+                scene_data[name] = element
+
+        export_ctx.scene_data = scene_data
+
+        # references to the included elements are written as usual
+        export_ctx.exported_ids.update(element['id'] for element in elements.values() if 'id' in element)
+
+        self.shared_elements[scene.frame_current] = (local_path, elements)
+
+    def write_shared_elements(self, scene):
+        '''
+        Write the elements that are the same in every frame to the shared
+        file, and the others to the local file of each frame.
+        '''
+
+        frame_elements = [elements for local_path, elements in self.shared_elements.values()]
+        shared = OrderedDict(
+            (name, element) for name, element in frame_elements[0].items()
+            if all(elements.get(name) == element for elements in frame_elements[1:])
+        )
+
+        # elements referencing frame local elements are frame local too
+        shared_ids = None
+
+        while shared_ids != set(element_id(name, element) for name, element in shared.items()):
+            shared_ids = set(element_id(name, element) for name, element in shared.items())
+
+            for name, element in list(shared.items()):
+                if not element_refs(element) <= shared_ids:
+                    del shared[name]
+
+        write_scene_file(scene, self.shared_filename, shared.items())
+
+        # the local files are included after the shared file
+        for local_path, elements in self.shared_elements.values():
+            write_scene_file(scene, local_path, [(name, element) for name, element in elements.items() if name not in shared], shared_ids)
+
+        MtsLog('Shared scene elements: %d of %d' % (len(shared), len(frame_elements[0])))
+
+    def export(self, samples=None):
         scene = self.scene
         self.shape_instances = {}
+        self.visibility = None
 
         try:
             if scene is None:
@@ -323,41 +808,74 @@ class SceneExporter:
 
             export_ctx.data_add(scene.mitsuba_integrator.api_output(), 'integrator')
 
-            self.GE = GeometryExporter(export_ctx, scene)
-            self.world_environment = Instance(scene.world, None)
-            self.scene_camera = Instance(scene.camera, None)
-            self.cache_motion(scene)
+            self.GE = GeometryExporter(export_ctx, scene, self.tessellations)
 
-            # Export world environment
-            export_world_environment(export_ctx, self.world_environment)
+            try:
+                self.world_environment = Instance(scene.world, None)
+                self.scene_camera = Instance(scene.camera, None)
+                if self.shared_elements is not None:
+                    self.GE.share_static_meshes = True
 
-            export_camera_instance(export_ctx, self.scene_camera, scene)
+                self.cache_motion(scene, samples)
 
-            cancel = False
-            b_sce = scene
+                # Export world environment
+                export_world_environment(export_ctx, self.world_environment)
 
-            while b_sce is not None and not cancel:
-                self.GE.geometry_scene = b_sce
+                export_camera_instance(export_ctx, self.scene_camera, scene)
 
-                for name, instance in self.shape_instances[b_sce.name].items():
-                    if cancel:
-                        break
+                cancel = False
+                b_sce = scene
 
-                    if instance.mesh is not None:
-                        self.GE.exportShapeInstances(instance, name)
+                while b_sce is not None and not cancel:
+                    self.GE.geometry_scene = b_sce
 
-                    elif instance.obj.type == 'LAMP':
-                        export_lamp_instance(export_ctx, instance, name)
+                    # shapegroup instances are collected and exported together
+                    table_instances = []
 
-                    # cancel = progress.get_cancel();
-                b_sce = b_sce.background_set
+                    for name, instance in self.shape_instances[b_sce.name].items():
+                        if cancel:
+                            break
+
+                        if isinstance(instance, ParticleInstance):
+                            self.GE.exportParticleInstances(instance, name)
+
+                        elif self.GE.allowInstanceTable(instance):
+                            table_instances.append((name, instance))
+
+                        elif instance.mesh is not None:
+                            self.GE.exportShapeInstances(instance, name)
+
+                        elif instance.obj.type == 'LAMP':
+                            export_lamp_instance(export_ctx, instance, name)
+
+                        # cancel = progress.get_cancel();
+
+                    self.GE.exportInstanceTable(table_instances)
+                    b_sce = b_sce.background_set
+
+                self.GE.objects_used_as_duplis.clear()
+
+            finally:
+                # the writer pool, the containers and the tessellated meshes
+                # are released even if the export fails
+                try:
+                    self.GE.closeContainers()
+
+                finally:
+                    self.GE.joinWriters()
+
+                    for cache_stats in self.GE.cacheStats():
+                        MtsLog(cache_stats)
+
+                    for store in self.GE.meshStores():
+                        MtsLog('Meshes in %s: %d reused, %d written' % (store.path, store.hits, store.misses))
 
-            self.GE.objects_used_as_duplis.clear()
+                    # meshes tessellated for a single export are freed with it
+                    if self.tessellations is None:
+                        self.GE.Tessellations.clear()
 
-            # update known exported objects for partial export
-            GeometryExporter.KnownModifiedObjects -= GeometryExporter.NewExportedObjects
-            GeometryExporter.KnownExportedObjects |= GeometryExporter.NewExportedObjects
-            GeometryExporter.NewExportedObjects = set()
+            if self.shared_elements is not None:
+                self.split_shared_elements(export_ctx, scene, mts_filename)
 
             export_ctx.configure()
 
@@ -24,17 +24,21 @@
 # System Libs
 import os
 import sys
+import shutil
+import tempfile
 import traceback
 
 # Blender Libs
 import bpy
 from bpy.types import Operator
-from bpy.props import BoolProperty, StringProperty
+from bpy.props import BoolProperty, IntProperty, StringProperty
 from bl_operators.presets import AddPresetBase
 
 from .. import MitsubaAddon
 from ..outputs import MtsLog
+from ..export import ExportProgressThread
 from ..export.scene import SceneExporter
+from ..export.frame_workers import FrameRangeExport, format_frames
 
 
 @MitsubaAddon.addon_register_class
@@ -102,8 +106,137 @@ class EXPORT_OT_mitsuba(Operator):
             return {'CANCELLED'}
 
 
+class FrameExportProgressThread(ExportProgressThread):
+    message = 'Exporting frames: %i%%'
+
+
+@MitsubaAddon.addon_register_class
+class EXPORT_OT_mitsuba_frames(Operator):
+    bl_idname = 'export.mitsuba_frames'
+    bl_label = 'Export Mitsuba Frame Range (.xml)'
+
+    filter_glob = StringProperty(default='*.xml', options={'HIDDEN'})
+    use_filter = BoolProperty(default=True, options={'HIDDEN'})
+    filename = StringProperty(name='Target filename', subtype='FILE_PATH')
+    directory = StringProperty(name='Target directory')
+
+    api_type = StringProperty(default='FILE', options={'HIDDEN'})
+    write_files = BoolProperty(default=True, options={'HIDDEN'})
+    write_all_files = BoolProperty(default=True, options={'HIDDEN'})
+
+    # The motion samples of a frame are recorded ahead of its export, holding
+    # the render meshes of all deforming objects at every subframe of the
+    # shutter at once. Each worker process holds those of its own frames.
+    frame_start = IntProperty(name='Start Frame', description='First frame to export', default=1)
+    frame_end = IntProperty(name='End Frame', description='Last frame to export', default=250)
+    shared_includes = BoolProperty(
+        name='Shared Includes',
+        description='Write materials, textures and static shapegroups that are the same in every frame to one shared file included by the frame files',
+        default=True
+    )
+    workers = IntProperty(
+        name='Workers',
+        description='Number of background Blender processes exporting slices of the frame range, 1 exports in this session. Every process holds the render meshes of the deforming objects at all motion samples of a frame',
+        default=1,
+        min=1,
+        soft_max=16
+    )
+
+    scene = StringProperty(options={'HIDDEN'}, default='')
+
+    def get_scene(self, context):
+        if self.properties.scene == '':
+            return context.scene
+
+        return bpy.data.scenes[self.properties.scene]
+
+    def invoke(self, context, event):
+        scene = self.get_scene(context)
+
+        if not self.properties.is_property_set('frame_start'):
+            self.properties.frame_start = scene.frame_start
+
+        if not self.properties.is_property_set('frame_end'):
+            self.properties.frame_end = scene.frame_end
+
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+    def export_workers(self, scene, frames):
+        '''
+        Export the frames with background Blender processes, which load a
+        copy of the current state of the .blend file.
+        '''
+
+        temp_dir = tempfile.mkdtemp(prefix='mtsblend_')
+
+        # the copy keeps the file name, as exported file paths are based on it
+        blend_path = os.path.join(temp_dir, os.path.basename(bpy.data.filepath) or 'untitled.blend')
+        bpy.ops.wm.save_as_mainfile(filepath=blend_path, copy=True, relative_remap=True)
+
+        frame_export = FrameRangeExport(
+            blend_path, frames, self.properties.directory, self.properties.filename,
+            workers=self.properties.workers,
+            scene=scene.name,
+            shared_includes=self.properties.shared_includes,
+            package=__name__.partition('.')[0],
+            blender=bpy.app.binary_path
+        )
+
+        progress_thread = FrameExportProgressThread()
+        progress_thread.start(len(frame_export.frames))
+
+        def progress(exported, total):
+            progress_thread.exported_objects = exported
+
+        try:
+            export_results = frame_export.run(progress)
+
+        finally:
+            progress_thread.stop()
+            progress_thread.join()
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+        for worker_frames, returncode, log in frame_export.failed_workers():
+            MtsLog('Worker of frames %s exited with code %s:\n%s' % (format_frames(worker_frames), returncode, '\n'.join(log)))
+
+        return export_results
+
+    def execute(self, context):
+        try:
+            scene = self.get_scene(context)
+            frames = range(self.properties.frame_start, self.properties.frame_end + 1)
+
+            if self.properties.workers > 1:
+                export_results = self.export_workers(scene, frames)
+
+            else:
+                scene_exporter = SceneExporter()
+                scene_exporter.set_properties(self.properties)
+                scene_exporter.set_scene(scene)
+
+                export_results = scene_exporter.export_frames(frames, self.properties.shared_includes)
+
+            failed = [frame for frame, result in sorted(export_results.items()) if not result or 'CANCELLED' in result]
+
+            if failed or len(export_results) < len(frames):
+                self.report({'ERROR'}, "Unsucessful export of frames: %s" % ', '.join(str(f) for f in frames if f in failed or f not in export_results))
+                return {'CANCELLED'}
+
+            return {'FINISHED'}
+
+        except:
+            typ, value, tb = sys.exc_info()
+            elist = traceback.format_exception(typ, value, tb)
+            MtsLog("Caught exception: %s" % ''.join(elist))
+            self.report({'ERROR'}, "Unsucessful export!")
+
+            return {'CANCELLED'}
+
+
 def menu_func(self, context):
     default_path = os.path.splitext(os.path.basename(bpy.data.filepath))[0] + ".xml"
     self.layout.operator("export.mitsuba", text="Export Mitsuba scene...").filename = default_path
+    self.layout.operator("export.mitsuba_frames", text="Export Mitsuba frame range...").filename = default_path
 
 bpy.types.INFO_MT_file_export.append(menu_func)
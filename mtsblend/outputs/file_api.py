@@ -27,21 +27,22 @@ import os
 import sys
 import subprocess
 
-from bpy_extras.io_utils import axis_conversion
-
 # Framework libs
 from ..extensions_framework import util as efutil
 
 # Exporter libs
 from ..export import ExportContextBase
-from ..export import matrix_to_list
+from ..export import simplify_motion
 from ..export import get_output_subdir
 from ..outputs import MtsLog, MtsManager
 from ..properties import ExportedVolumes
 
+# the 16 values of a flattened transform matrix
+MATRIX_FORMAT = ' '.join(['%f'] * 16)
 
 mitsuba_props = {
     'ref',
+    'include',
     'lookat',
     'scale',
     'matrix',
@@ -409,7 +410,7 @@ class FileExportContext(ExportContextBase):
                 MtsLog('************** Reference ID - %s - exported before referencing **************' % (args['id']))
                 return
 
-            elif plugin in {'matrix', 'lookat', 'scale'}:
+            elif plugin in {'matrix', 'lookat', 'scale', 'include'}:
                 del args['name']
 
         else:
@@ -596,23 +597,24 @@ class FileExportContext(ExportContextBase):
 
         return params
 
-    def transform_matrix(self, matrix):
-        # Blender is Z up but Mitsuba is Y up, convert the matrix
-        global_matrix = axis_conversion(to_forward="-Z", to_up="Y").to_4x4()
-        l = matrix_to_list(global_matrix * matrix)
-        value = " ".join(["%f" % f for f in l])
-
+    def transform_list(self, l):
+        # l is a converted matrix, as returned by matrix_to_list
         params = {
             'type': 'transform',
             'matrix': {
                 'type': 'matrix',
-                'value': value,
+                'value': MATRIX_FORMAT % tuple(l),
             }
         }
 
         return params
 
-    def animated_transform(self, motion):
+    def animated_transform_list(self, motion, simplify=True):
+        # motion holds (time, converted matrix list) pairs, bulk exports
+        # simplify the motions themselves with linear_motions
+        if simplify:
+            motion = simplify_motion(motion)
+
         if len(motion) == 2 and motion[0][1] == motion[1][1]:
             del motion[1]
 
@@ -623,15 +625,15 @@ class FileExportContext(ExportContextBase):
                 ('type', 'animation'),
             ])
 
-            for (t, m) in motion:
-                mat = self.transform_matrix(m)
+            for (t, l) in motion:
+                mat = self.transform_list(l)
                 mat.update({'time': t})
                 params.update([
                     ('trafo%f' % t, mat)
                 ])
 
         else:
-            params = self.transform_matrix(motion[0][1])
+            params = self.transform_list(motion[0][1])
 
         return params
 
@@ -0,0 +1,165 @@
+# -*- coding: utf8 -*-
+#
+# ***** BEGIN GPL LICENSE BLOCK *****
+#
+# --------------------------------------------------------------------------
+# Blender Mitsuba Add-On
+# --------------------------------------------------------------------------
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+#
+# ***** END GPL LICENSE BLOCK *****
+
+
+import functools
+
+import numpy
+
+HAIR_BINARY_MAGIC = b'BINARY_HAIR'
+
+
+def hair_strands(points, strand_lengths):
+    '''
+    points              numpy.ndarray (n, 3) of all strand points
+    strand_lengths      numpy.ndarray of the number of points of each strand
+
+    Returns list of (k, 3) arrays, one per strand
+    '''
+
+    if len(strand_lengths) == 0:
+        return []
+
+    return numpy.split(points, numpy.cumsum(strand_lengths)[:-1])
+
+
+@functools.lru_cache(maxsize=64)
+def bspline_weights(num_points, degree, num_samples):
+    '''
+    num_points          int number of control points
+    degree              int degree of the B-spline
+    num_samples         int number of points sampled along the curve
+
+    Basis function weights of a clamped uniform B-spline, evaluated at
+    evenly spaced parameters. They only depend on the point count, so
+    they are computed once and shared by all strands of that length.
+
+    Returns numpy.ndarray (num_samples, num_points)
+    '''
+
+    # clamped knot vector
+    knots = numpy.empty(num_points + degree + 1, dtype=numpy.float64)
+
+    for i in range(len(knots)):
+        if i <= degree:
+            knots[i] = 0
+
+        elif i >= num_points:
+            knots[i] = num_points - degree
+
+        else:
+            knots[i] = i - degree
+
+    # sample parameters, the last one is kept inside the final knot span
+    if num_samples > 1:
+        u = numpy.arange(num_samples) * (num_points - degree) / (num_samples - 1)
+        u[1:] -= 0.0000000000001
+
+    else:
+        u = numpy.zeros(1)
+
+    # Cox-de Boor recursion, one degree at a time for all samples
+    basis = ((knots[None, :-1] <= u[:, None]) & (u[:, None] < knots[None, 1:])).astype(numpy.float64)
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        for d in range(1, degree + 1):
+            n = len(knots) - 1 - d
+            left = (u[:, None] - knots[None, :n]) / (knots[None, d:n + d] - knots[None, :n]) * basis[:, :n]
+            right = (knots[None, d + 1:n + d + 1] - u[:, None]) / (knots[None, d + 1:n + d + 1] - knots[None, 1:n + 1]) * basis[:, 1:n + 1]
+
+            # terms of zero basis functions are zero, whatever their knot spans
+            basis = numpy.where(basis[:, :n] != 0, left, 0.0) + numpy.where(basis[:, 1:n + 1] != 0, right, 0.0)
+
+    return basis[:, :num_points]
+
+
+def resample_bspline(points, strand_lengths, degree, num_samples):
+    '''
+    points              numpy.ndarray (n, 3) of all strand points
+    strand_lengths      numpy.ndarray of the number of points of each strand
+    degree              int degree of the B-spline
+    num_samples         int number of points of each resampled strand
+
+    Smooth all strands with a B-spline through their points. Strands of
+    the same length are resampled together with a single matrix product.
+
+    Returns (points, strand_lengths) of the resampled strands
+    '''
+
+    strand_lengths = numpy.asarray(strand_lengths, dtype=numpy.int64)
+    starts = numpy.cumsum(strand_lengths) - strand_lengths
+    resampled = numpy.zeros((len(strand_lengths), num_samples, 3), dtype=numpy.float64)
+
+    for length in numpy.unique(strand_lengths).tolist():
+        strands = numpy.flatnonzero(strand_lengths == length)
+
+        if length == 0:
+            continue
+
+        # (strands, length, 3) control points of all strands of this length
+        controls = points[starts[strands, None] + numpy.arange(length)[None, :]]
+        weights = bspline_weights(length, degree, num_samples)
+        resampled[strands] = numpy.tensordot(controls, weights, axes=([1], [1])).transpose((0, 2, 1))
+
+    return resampled.reshape((-1, 3)), numpy.full(len(strand_lengths), num_samples, dtype=numpy.int64)
+
+
+def write_hair_ascii(hair_path, points, strand_lengths):
+    '''
+    Write a hair file in the ASCII format: one point per line,
+    strands separated by an empty line.
+    '''
+
+    with open(hair_path, 'w') as hair_file:
+        for strand in hair_strands(points, strand_lengths):
+            for p in strand.tolist():
+                hair_file.write('%f %f %f\n' % (p[0], p[1], p[2]))
+
+            hair_file.write('\n')
+
+
+def write_hair_binary(hair_path, points, strand_lengths):
+    '''
+    Write a hair file in the binary format: the BINARY_HAIR magic, the
+    vertex count as a 32 bit integer, then the single precision XYZ points
+    of all strands, separated by a single +inf value.
+    '''
+
+    strand_lengths = numpy.asarray(strand_lengths, dtype=numpy.int64)
+    strand_lengths = strand_lengths[strand_lengths > 0]
+    nverts = int(strand_lengths.sum())
+
+    # each point is shifted by the number of separators before its strand
+    strand_of_point = numpy.repeat(numpy.arange(len(strand_lengths)), strand_lengths)
+    offsets = 3 * numpy.arange(nverts) + strand_of_point
+
+    data = numpy.empty(3 * nverts + max(len(strand_lengths) - 1, 0), dtype='<f4')
+    data.fill(numpy.inf)
+
+    for axis in range(3):
+        data[offsets + axis] = points[:, axis]
+
+    with open(hair_path, 'wb') as hair_file:
+        hair_file.write(HAIR_BINARY_MAGIC)
+        hair_file.write(numpy.array([nverts], dtype='<u4').tobytes())
+        hair_file.write(memoryview(data.view(numpy.uint8)))
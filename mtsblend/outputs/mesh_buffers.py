@@ -0,0 +1,508 @@
+# -*- coding: utf8 -*-
+#
+# ***** BEGIN GPL LICENSE BLOCK *****
+#
+# --------------------------------------------------------------------------
+# Blender Mitsuba Add-On
+# --------------------------------------------------------------------------
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+#
+# ***** END GPL LICENSE BLOCK *****
+
+import hashlib
+import threading
+
+import numpy
+
+
+def _foreach_get(collection, attr, count, width, dtype):
+    data = numpy.empty(count * width, dtype=dtype)
+
+    if count > 0:
+        collection.foreach_get(attr, data)
+
+    if width > 1:
+        data.shape = (count, width)
+
+    return data
+
+
+def _read_uv(mesh, nfaces):
+    uv_textures = mesh.tessface_uv_textures
+
+    if len(uv_textures) > 0 and mesh.uv_textures.active and uv_textures.active.data:
+        uv = _foreach_get(uv_textures.active.data, 'uv_raw', nfaces, 8, numpy.float32)
+        return uv.reshape((nfaces, 4, 2))
+
+    return None
+
+
+def _read_color(mesh, nfaces):
+    vertex_color = mesh.tessface_vertex_colors.active
+
+    if not vertex_color:
+        return None
+
+    color = numpy.empty((nfaces, 4, 3), dtype=numpy.float32)
+
+    for j in range(4):
+        color[:, j] = _foreach_get(vertex_color.data, 'color%d' % (j + 1), nfaces, 3, numpy.float32)
+
+    return color
+
+
+def _same_corners(a, b):
+    if a is None or b is None:
+        return a is b
+
+    return numpy.array_equal(a, b)
+
+
+def unique_rows(rows):
+    '''
+    rows                numpy.ndarray (n, k)
+
+    Find the distinct rows of a 2D array, keeping the first occurrence
+    of every row. -0.0 and 0.0 are considered equal, as they are when
+    comparing python float tuples.
+
+    Returns (first, inverse): index of the first occurrence of each
+    distinct row, and for every row the index of its distinct row.
+    '''
+
+    keys = numpy.ascontiguousarray(rows + 0.0)
+    keys = keys.view(numpy.dtype((numpy.void, keys.dtype.itemsize * keys.shape[1]))).ravel()
+
+    # return_index sorts with a stable algorithm, so first holds first occurrences
+    _, first, inverse = numpy.unique(keys, return_index=True, return_inverse=True)
+
+    return first, inverse.ravel()
+
+
+class SubMesh:
+    '''
+    Triangulated, exportable vertex and index buffers of one mesh part.
+
+    Buffers left to None are not exported. Without normals, Mitsuba
+    computes them from the faces.
+
+    vertex_source holds the Blender vertex of every exported vertex, and
+    face_source the Blender face of flat shaded vertices (-1 for smooth
+    ones), so that the buffers can be refilled from a deformed mesh.
+    '''
+
+    def __init__(self, points, normals, uvs, colors, indices, vertex_source=None, face_source=None):
+        self.points = points
+        self.normals = normals
+        self.uvs = uvs
+        self.colors = colors
+        self.indices = indices
+        self.vertex_source = vertex_source
+        self.face_source = face_source
+
+    @property
+    def vertex_count(self):
+        return len(self.points)
+
+    @property
+    def triangle_count(self):
+        return len(self.indices)
+
+    def digest(self):
+        '''
+        Hash of the exported buffers, identical parts give the same digest
+
+        Returns str
+        '''
+
+        h = hashlib.sha1()
+
+        for name in ('points', 'normals', 'uvs', 'colors', 'indices'):
+            data = getattr(self, name)
+            h.update(name.encode())
+
+            if data is not None:
+                h.update(str(data.shape).encode())
+                h.update(numpy.ascontiguousarray(data).view(numpy.uint8))
+
+        return h.hexdigest()
+
+    def deformed(self, vertex_co, vertex_normal, face_normal):
+        '''
+        vertex_co           numpy.ndarray (n, 3) of Blender vertex positions
+        vertex_normal       numpy.ndarray (n, 3) of Blender vertex normals
+        face_normal         numpy.ndarray (m, 3) of Blender face normals, or None
+                            if no vertex is flat shaded
+
+        Returns SubMesh with the same topology, UVs and colors, and the
+        positions and normals of the deformed mesh
+        '''
+
+        points = vertex_co[self.vertex_source].astype(numpy.float64)
+        normals = None
+
+        if self.normals is not None:
+            normals = vertex_normal[self.vertex_source].astype(numpy.float64)
+
+            if self.face_source is not None:
+                flat = self.face_source >= 0
+                normals[flat] = face_normal[self.face_source[flat]]
+
+        return SubMesh(points, normals, self.uvs, self.colors, self.indices, self.vertex_source, self.face_source)
+
+
+class MeshBuffers:
+    '''
+    Bulk copy of the tessface data of a Blender mesh, read with foreach_get
+    into NumPy arrays. The arrays do not reference Blender data, so the mesh
+    can be freed once they have been read.
+    '''
+
+    def __init__(self, mesh):
+        nverts = len(mesh.vertices)
+        nfaces = len(mesh.tessfaces)
+
+        self.vertex_co = _foreach_get(mesh.vertices, 'co', nverts, 3, numpy.float32)
+        self.vertex_normal = _foreach_get(mesh.vertices, 'normal', nverts, 3, numpy.float32)
+
+        # Triangles have 0 as their fourth vertex index, Blender never
+        # stores a quad with vertex 0 in the last position.
+        self.face_vertices = _foreach_get(mesh.tessfaces, 'vertices_raw', nfaces, 4, numpy.uint32)
+        self.face_smooth = _foreach_get(mesh.tessfaces, 'use_smooth', nfaces, 1, numpy.bool_)
+        self.face_normal = _foreach_get(mesh.tessfaces, 'normal', nfaces, 3, numpy.float32)
+        self.face_material = _foreach_get(mesh.tessfaces, 'material_index', nfaces, 1, numpy.int16)
+
+        self.uv = _read_uv(mesh, nfaces)
+        self.color = _read_color(mesh, nfaces)
+
+    def digest(self):
+        '''
+        Hash of all mesh data, identical meshes give the same digest
+
+        Returns str
+        '''
+
+        h = hashlib.sha1()
+
+        for name in ('vertex_co', 'vertex_normal', 'face_vertices', 'face_smooth', 'face_normal', 'face_material', 'uv', 'color'):
+            data = getattr(self, name)
+            h.update(name.encode())
+
+            if data is not None:
+                h.update(str(data.shape).encode())
+                h.update(numpy.ascontiguousarray(data).view(numpy.uint8))
+
+        return h.hexdigest()
+
+    def material_faces(self, mat_index):
+        return numpy.flatnonzero(self.face_material == mat_index)
+
+    def material_indices(self):
+        return [int(i) for i in numpy.flatnonzero(numpy.bincount(self.face_material.astype(numpy.intp)))]
+
+    def submesh(self, faces):
+        '''
+        faces               numpy.ndarray of face indices
+
+        Build the vertex and triangle buffers for the given faces, in the
+        same vertex order as the python mesh writers: smooth face corners
+        are merged with the first corner sharing position, normal, UV and
+        color, flat face corners are always written as new vertices and
+        quads are split into (0, 1, 2) and (0, 2, 3).
+
+        Returns SubMesh
+        '''
+
+        return self._build_submeshes(faces, numpy.zeros(len(faces), dtype=numpy.intp), 1)[0]
+
+    def preserves_topology(self, face_normals=False):
+        '''
+        face_normals        bool, normals are computed by Mitsuba from the faces
+
+        Check whether every face corner can be exported as its Blender
+        vertex: the mesh has no vertex colors and no UV seams, and all
+        faces are smooth unless face normals are used.
+
+        Returns bool
+        '''
+
+        if self.color is not None:
+            return False
+
+        if not face_normals and not self.face_smooth.all():
+            return False
+
+        if self.uv is not None:
+            corner_mask, corner_face, corner_vert = self._corners(numpy.arange(len(self.face_vertices)))
+            corner_uv = self.uv.reshape((-1, 2))[corner_mask]
+
+            # every corner of a vertex must carry the same UV
+            vertex_uv = numpy.empty((len(self.vertex_co), 2), dtype=corner_uv.dtype)
+            vertex_uv[corner_vert] = corner_uv
+
+            if not numpy.array_equal(vertex_uv[corner_vert], corner_uv):
+                return False
+
+        return True
+
+    def topology_submesh(self, faces, normals=True):
+        '''
+        faces               numpy.ndarray of face indices
+        normals             bool, export the vertex normals
+
+        Build the buffers for the given faces straight from the Blender
+        vertex arrays, without merging face corners. The vertices used by
+        the faces are written in Blender order. Only valid if
+        preserves_topology() is True.
+
+        Returns SubMesh
+        '''
+
+        corner_mask, corner_face, corner_vert = self._corners(faces)
+
+        used = numpy.zeros(len(self.vertex_co), dtype=bool)
+        used[corner_vert] = True
+        vertices = numpy.flatnonzero(used)
+        remap = numpy.cumsum(used, dtype=numpy.int64) - 1
+
+        uvs = None
+
+        if self.uv is not None:
+            uv = numpy.empty((len(self.vertex_co), 2), dtype=numpy.float64)
+            uv[corner_vert] = self.uv[faces].reshape((-1, 2))[corner_mask]
+            uvs = uv[vertices]
+            # Flip UV Y axis. Blender UV coord is bottom-left, Mitsuba is top-left.
+            uvs[:, 1] = 1.0 - uvs[:, 1]
+
+        return SubMesh(
+            self.vertex_co[vertices].astype(numpy.float64),
+            self.vertex_normal[vertices].astype(numpy.float64) if normals else None,
+            uvs,
+            None,
+            self._triangles(remap[self.face_vertices[faces]], corner_mask).astype(numpy.uint32),
+            vertices,
+        )
+
+    def split_materials(self, face_normals=False, by_vertex=False):
+        '''
+        face_normals        bool, normals are computed by Mitsuba from the faces
+        by_vertex           bool, only merge corners of the same Blender vertex
+
+        Build the buffers of all material parts of the mesh in one pass.
+        Faces are sorted by material index and processed together, every
+        part then gets a contiguous slice of the shared vertex pool. The
+        result of each part is the same as submesh(material_faces(i)).
+
+        Meshes passing preserves_topology() are exported with
+        topology_submesh() instead, without normals if face_normals is set.
+
+        Returns dict of material index: SubMesh
+        '''
+
+        if self.preserves_topology(face_normals):
+            return {i: self.topology_submesh(self.material_faces(i), not face_normals) for i in self.material_indices()}
+
+        material = self.face_material.astype(numpy.intp)
+        faces = numpy.argsort(material, kind='mergesort')
+        groups = numpy.bincount(material)
+        parts = self._build_submeshes(faces, material[faces], len(groups), by_vertex)
+
+        return {int(i): parts[i] for i in numpy.flatnonzero(groups)}
+
+    def _corners(self, faces):
+        # face corners in export order, the fourth corner only exists on quads
+        fverts = self.face_vertices[faces]
+
+        corner_mask = numpy.ones((len(faces), 4), dtype=bool)
+        corner_mask[:, 3] = fverts[:, 3] != 0
+        corner_mask = corner_mask.ravel()
+
+        corner_face = numpy.repeat(numpy.arange(len(faces)), 4)[corner_mask]
+        corner_vert = fverts.ravel()[corner_mask]
+
+        return corner_mask, corner_face, corner_vert
+
+    def _triangles(self, face_corners, corner_mask):
+        # triangulate (n, 4) corner indices into (0, 1, 2) and (0, 2, 3),
+        # keeping the triangles of a face next to each other
+        nfaces = len(face_corners)
+        tris = numpy.empty((nfaces, 2, 3), dtype=face_corners.dtype)
+        tris[:, 0] = face_corners[:, [0, 1, 2]]
+        tris[:, 1] = face_corners[:, [0, 2, 3]]
+
+        tri_mask = numpy.ones((nfaces, 2), dtype=bool)
+        tri_mask[:, 1] = corner_mask.reshape((nfaces, 4))[:, 3]
+
+        return tris.reshape((-1, 3))[tri_mask.ravel()]
+
+    def _build_submeshes(self, faces, face_group, ngroups, by_vertex=False):
+        # faces must be sorted by group, so that the vertices and triangles
+        # of each group end up in one contiguous range. With by_vertex,
+        # corners of separate vertices are never merged even if their data
+        # is equal, so that the result stays valid when the mesh deforms
+        nfaces = len(faces)
+        corner_mask, corner_face, corner_vert = self._corners(faces)
+        is_quad = corner_mask.reshape((nfaces, 4))[:, 3]
+        smooth = self.face_smooth[faces][corner_face]
+
+        columns = [
+            self.vertex_co[corner_vert],
+            numpy.where(smooth[:, None], self.vertex_normal[corner_vert], self.face_normal[faces][corner_face]),
+        ]
+
+        if self.uv is not None:
+            # Flip UV Y axis. Blender UV coord is bottom-left, Mitsuba is top-left.
+            uv = self.uv[faces].reshape((-1, 2))[corner_mask].astype(numpy.float64)
+            uv[:, 1] = 1.0 - uv[:, 1]
+            columns.append(uv)
+
+        if self.color is not None:
+            columns.append(self.color[faces].reshape((-1, 3))[corner_mask])
+
+        corner_data = numpy.hstack([c.astype(numpy.float64) for c in columns])
+
+        # every corner refers to the first corner of its group carrying the same vertex
+        ncorners = len(corner_data)
+        first = numpy.arange(ncorners)
+        smooth_corners = numpy.flatnonzero(smooth)
+
+        if len(smooth_corners) > 0:
+            keys = corner_data[smooth_corners]
+
+            if by_vertex:
+                keys = numpy.hstack((corner_vert[smooth_corners, None].astype(numpy.float64), keys))
+
+            if ngroups > 1:
+                keys = numpy.hstack((face_group[corner_face[smooth_corners], None].astype(numpy.float64), keys))
+
+            sfirst, sinverse = unique_rows(keys)
+            first[smooth_corners] = smooth_corners[sfirst[sinverse]]
+
+        is_new = first == numpy.arange(ncorners)
+        export_index = numpy.cumsum(is_new, dtype=numpy.int64) - 1
+        corner_index = export_index[first]
+
+        # exported vertex of every slot of the (n, 4) corner grid
+        corner_pos = numpy.cumsum(corner_mask) - 1
+        tris = self._triangles(corner_index[corner_pos].reshape((nfaces, 4)), corner_mask)
+        tri_mask = numpy.ones((nfaces, 2), dtype=bool)
+        tri_mask[:, 1] = is_quad
+        tri_mask = tri_mask.ravel()
+
+        vertex_data = corner_data[is_new]
+        vertex_source = corner_vert[is_new]
+        face_source = None
+
+        if not smooth.all():
+            face_source = numpy.where(smooth, -1, faces[corner_face])[is_new]
+        vertex_bounds = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(face_group[corner_face[is_new]], minlength=ngroups))))
+        tri_group = numpy.repeat(face_group, 2)[tri_mask]
+        tri_bounds = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(tri_group, minlength=ngroups))))
+
+        parts = []
+
+        for g in range(ngroups):
+            vstart, vend = vertex_bounds[g], vertex_bounds[g + 1]
+            tstart, tend = tri_bounds[g], tri_bounds[g + 1]
+            data = vertex_data[vstart:vend]
+            uvs = None
+            colors = None
+            col = 6
+
+            if self.uv is not None:
+                uvs = data[:, col:col + 2]
+                col += 2
+
+            if self.color is not None:
+                colors = data[:, col:col + 3]
+
+            parts.append(SubMesh(
+                data[:, 0:3],
+                data[:, 3:6],
+                uvs,
+                colors,
+                (tris[tstart:tend] - vstart).astype(numpy.uint32),
+                vertex_source[vstart:vend],
+                face_source[vstart:vend] if face_source is not None else None,
+            ))
+
+        return parts
+
+
+class MaterialParts:
+    '''
+    Material parts of a mesh, split from its buffers in a single pass when
+    the first part is requested. The parts of meshes written in the
+    background are then split on the writer thread too.
+    '''
+
+    def __init__(self, mesh_buffers, face_normals=False, submeshes=None):
+        self.mesh_buffers = mesh_buffers
+        self.face_normals = face_normals
+        self.submeshes = submeshes
+        self.lock = threading.Lock()
+
+    def __getitem__(self, mat_index):
+        with self.lock:
+            if self.submeshes is None:
+                self.submeshes = self.mesh_buffers.split_materials(self.face_normals)
+
+        return self.submeshes[mat_index]
+
+
+class DeformationTopology:
+    '''
+    Exportable buffers of the first time sample of a deforming mesh. The
+    corner merging, triangulation, UVs and colors are computed once, later
+    time samples read the vertex positions and normals of the mesh and
+    gather them into the same buffers. The UVs and colors of every sample
+    are read as well, as they may be animated, and compared to those of
+    the first sample.
+    '''
+
+    def __init__(self, mesh_buffers, face_normals=False):
+        self.vertex_count = len(mesh_buffers.vertex_co)
+        self.face_count = len(mesh_buffers.face_vertices)
+        self.uv = mesh_buffers.uv
+        self.color = mesh_buffers.color
+        self.submeshes = mesh_buffers.split_materials(face_normals, by_vertex=True)
+        self.flat_faces = any(s.normals is not None and s.face_source is not None for s in self.submeshes.values())
+
+    def deform(self, mesh):
+        '''
+        mesh                bpy.types.Mesh time sample of the mesh, with tessfaces
+
+        Returns dict of material index: SubMesh, or None if the topology,
+        the UVs or the colors of the mesh changed
+        '''
+
+        nverts = len(mesh.vertices)
+        nfaces = len(mesh.tessfaces)
+
+        if nverts != self.vertex_count or nfaces != self.face_count:
+            return None
+
+        # UV warps and dynamic paint change the corners, the mesh is then read again
+        if not _same_corners(_read_uv(mesh, nfaces), self.uv) or not _same_corners(_read_color(mesh, nfaces), self.color):
+            return None
+
+        vertex_co = _foreach_get(mesh.vertices, 'co', nverts, 3, numpy.float32)
+        vertex_normal = _foreach_get(mesh.vertices, 'normal', nverts, 3, numpy.float32)
+        face_normal = None
+
+        if self.flat_faces:
+            face_normal = _foreach_get(mesh.tessfaces, 'normal', nfaces, 3, numpy.float32)
+
+        return {i: s.deformed(vertex_co, vertex_normal, face_normal) for i, s in self.submeshes.items()}
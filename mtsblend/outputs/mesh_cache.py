@@ -0,0 +1,152 @@
+# -*- coding: utf8 -*-
+#
+# ***** BEGIN GPL LICENSE BLOCK *****
+#
+# --------------------------------------------------------------------------
+# Blender Mitsuba Add-On
+# --------------------------------------------------------------------------
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+#
+# ***** END GPL LICENSE BLOCK *****
+
+import os
+import hashlib
+import threading
+
+
+class MeshCache:
+    '''
+    Content addressed store of exported mesh files.
+
+    Files are named after a hash of the mesh data and the writer settings
+    they were created with, so a mesh is encoded and written only once,
+    whatever object, frame, scene or session it comes from. Stored files
+    are listed in an index file in the cache directory, which is appended
+    to by every exporter sharing the cache.
+    '''
+
+    INDEX_NAME = 'index.txt'
+
+    # Change this when the mesh writers produce different files for the same data
+    VERSION = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.index = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self.load_index()
+
+    @property
+    def index_path(self):
+        return os.path.join(self.path, self.INDEX_NAME)
+
+    def load_index(self):
+        self.index = {}
+
+        if not os.path.exists(self.index_path):
+            return
+
+        with open(self.index_path, 'r') as index_file:
+            for line in index_file:
+                try:
+                    key, file_name = line.split()
+
+                except ValueError:
+                    continue
+
+                # entries of files removed by hand are dropped
+                if os.path.exists(os.path.join(self.path, file_name)):
+                    self.index[key] = file_name
+
+    def key(self, mesh_digest, *settings):
+        '''
+        mesh_digest         str hash of the mesh data
+        settings            writer settings affecting the file contents
+
+        Returns str
+        '''
+
+        h = hashlib.sha1(mesh_digest.encode())
+        h.update(repr((self.VERSION,) + settings).encode())
+
+        return h.hexdigest()
+
+    def file_path(self, key, file_format):
+        '''
+        key                 str from key()
+        file_format         file extension
+
+        Returns the path the mesh is stored at, whether it exists or not
+        '''
+
+        return os.path.join(self.path, '%s.%s' % (key, file_format))
+
+    def get(self, key, file_format):
+        '''
+        key                 str from key()
+        file_format         file extension
+
+        Returns the path of the cached file, or None
+        '''
+
+        file_path = self.file_path(key, file_format)
+        file_name = os.path.basename(file_path)
+
+        with self.lock:
+            if key not in self.index:
+                # the file may have been added by another exporter since loading
+                if not os.path.exists(file_path):
+                    self.misses += 1
+                    return None
+
+                self.index[key] = file_name
+
+            self.hits += 1
+
+        return file_path
+
+    def store(self, key, file_format, write_file):
+        '''
+        key                 str from key()
+        file_format         file extension
+        write_file          function writing the mesh to the given path
+
+        Write a new mesh file into the cache.
+
+        Returns the path of the cached file
+        '''
+
+        file_path = self.file_path(key, file_format)
+        file_name = os.path.basename(file_path)
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path, exist_ok=True)
+
+        # write to a temporary file, so that no other exporter ever sees
+        # a partially written mesh
+        temp_path = '%s.%d.%d.tmp' % (file_path, os.getpid(), threading.get_ident())
+        write_file(temp_path)
+        os.replace(temp_path, file_path)
+
+        with self.lock:
+            with open(self.index_path, 'a') as index_file:
+                index_file.write('%s %s\n' % (key, file_name))
+
+            self.index[key] = file_name
+
+        return file_path
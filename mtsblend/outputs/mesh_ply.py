@@ -23,6 +23,8 @@
 
 import struct
 
+import numpy
+
 
 def write_ply_mesh(ply_path, mesh_name, mesh, ffaces_mats):
     uv_textures = mesh.tessface_uv_textures
@@ -152,3 +154,52 @@ def write_ply_mesh(ply_path, mesh_name, mesh, ffaces_mats):
 
         del co_no_uv_cache
         del face_vert_indices
+
+
+def write_ply_submesh(ply_path, mesh_name, submesh):
+    vertex_format = [('x', '<f4'), ('y', '<f4'), ('z', '<f4')]
+
+    if submesh.normals is not None:
+        vertex_format.extend([('nx', '<f4'), ('ny', '<f4'), ('nz', '<f4')])
+
+    if submesh.uvs is not None:
+        vertex_format.extend([('s', '<f4'), ('t', '<f4')])
+
+    if submesh.colors is not None:
+        vertex_format.extend([('r', '<f4'), ('g', '<f4'), ('b', '<f4')])
+
+    # Fill the element records column by column, each element is
+    # then written to the file in a single call.
+    vertices = numpy.empty(submesh.vertex_count, dtype=vertex_format)
+    vertices['x'], vertices['y'], vertices['z'] = submesh.points.T
+
+    if submesh.normals is not None:
+        vertices['nx'], vertices['ny'], vertices['nz'] = submesh.normals.T
+
+    if submesh.uvs is not None:
+        vertices['s'], vertices['t'] = submesh.uvs.T
+
+    if submesh.colors is not None:
+        vertices['r'], vertices['g'], vertices['b'] = submesh.colors.T
+
+    faces = numpy.empty(submesh.triangle_count, dtype=[('count', 'u1'), ('indices', '<u4', 3)])
+    faces['count'] = 3
+    faces['indices'] = submesh.indices
+
+    with open(ply_path, 'wb') as ply:
+        header = [
+            'ply',
+            'format binary_little_endian 1.0',
+            'comment Created by MtsBlend 2.5 exporter for Mitsuba - www.mitsuba.net',
+            'element vertex %d' % submesh.vertex_count,
+        ]
+        header.extend(['property float %s' % name for name, fmt in vertex_format])
+        header.extend([
+            'element face %d' % submesh.triangle_count,
+            'property list uchar uint vertex_indices',
+            'end_header',
+        ])
+
+        ply.write(('\n'.join(header) + '\n').encode())
+        ply.write(memoryview(vertices.view(numpy.uint8)))
+        ply.write(memoryview(faces.view(numpy.uint8)))
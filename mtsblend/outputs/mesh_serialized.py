@@ -24,18 +24,47 @@
 import struct
 import array
 import zlib
+import tempfile
+import itertools
+import collections
+import multiprocessing
 
+from concurrent.futures import ThreadPoolExecutor
+
+SERIALIZED_MAGIC = 0x041C
+SERIALIZED_VERSION = 0x0004
+
+# mesh flags
+FLAG_VERTEX_NORMALS = 0x0001
+FLAG_TEXCOORDS = 0x0002
+FLAG_VERTEX_COLORS = 0x0008
+FLAG_SINGLE_PRECISION = 0x1000
+FLAG_DOUBLE_PRECISION = 0x2000
+
+
+def precision_flag(precision):
+    if precision == 'single':
+        return FLAG_SINGLE_PRECISION
+
+    return FLAG_DOUBLE_PRECISION
+
+
+def encode_mesh(mesh, ffaces_mats, precision='double'):
+    '''
+    Collect the serialized mesh buffers of a list of tessfaces, face by face.
+    precision is 'single' or 'double', for 32 or 64 bit floats.
+
+    Returns (flags, vertex count, triangle count, list of buffers)
+    '''
 
-def write_serialized_mesh(ser_path, mesh_name, mesh, ffaces_mats):
     uv_textures = mesh.tessface_uv_textures
 
+    uv_layer = None
+
     if len(uv_textures) > 0:
         if mesh.uv_textures.active and uv_textures.active.data:
             uv_layer = uv_textures.active.data
 
-    else:
-        uv_layer = None
-
     vertex_color = mesh.tessface_vertex_colors.active
 
     if vertex_color:
@@ -44,11 +73,13 @@ def write_serialized_mesh(ser_path, mesh_name, mesh, ffaces_mats):
     else:
         vertex_color_layer = None
 
+    float_type = 'f' if precision == 'single' else 'd'
+
     # Export data
-    points = array.array('d', [])
-    normals = array.array('d', [])
-    uvs = array.array('d', [])
-    vtx_colors = array.array('d', [])
+    points = array.array(float_type, [])
+    normals = array.array(float_type, [])
+    uvs = array.array(float_type, [])
+    vtx_colors = array.array(float_type, [])
     ntris = 0
     face_vert_indices = array.array('I', [])  # list of face vert indices
 
@@ -146,41 +177,405 @@ def write_serialized_mesh(ser_path, mesh_name, mesh, ffaces_mats):
     del vert_vno_indices
     del vert_use_vno
 
-    with open(ser_path, 'wb') as ser:
-        # create mesh flags
-        flags = 0
-        # turn on double precision
-        flags = flags | 0x2000
-        # turn on vertex normals
-        flags = flags | 0x0001
+    # create mesh flags
+    flags = 0
+    # turn on single or double precision
+    flags = flags | precision_flag(precision)
+    # turn on vertex normals
+    flags = flags | FLAG_VERTEX_NORMALS
+
+    data = [points.tobytes(), normals.tobytes()]
+
+    # turn on uv layer
+    if uv_layer:
+        flags = flags | FLAG_TEXCOORDS
+        data.append(uvs.tobytes())
+
+    if vertex_color_layer:
+        flags = flags | FLAG_VERTEX_COLORS
+        data.append(vtx_colors.tobytes())
+
+    data.append(face_vert_indices.tobytes())
+
+    return flags, vert_index, int(ntris / 3), data
+
+
+def encode_submesh(submesh, precision='double'):
+    '''
+    Collect the serialized mesh buffers of a SubMesh.
+    precision is 'single' or 'double', for 32 or 64 bit floats.
+
+    Returns (flags, vertex count, triangle count, list of buffers)
+    '''
+
+    float_type = '<f4' if precision == 'single' else '<f8'
+
+    # create mesh flags
+    flags = 0
+    # turn on single or double precision
+    flags = flags | precision_flag(precision)
+
+    data = [submesh.points.astype(float_type).tobytes()]
+
+    # turn on vertex normals
+    if submesh.normals is not None:
+        flags = flags | FLAG_VERTEX_NORMALS
+        data.append(submesh.normals.astype(float_type).tobytes())
+
+    # turn on uv layer
+    if submesh.uvs is not None:
+        flags = flags | FLAG_TEXCOORDS
+        data.append(submesh.uvs.astype(float_type).tobytes())
+
+    if submesh.colors is not None:
+        flags = flags | FLAG_VERTEX_COLORS
+        data.append(submesh.colors.astype(float_type).tobytes())
+
+    data.append(submesh.indices.astype('<u4').tobytes())
+
+    return flags, submesh.vertex_count, submesh.triangle_count, data
+
+
+# Rough peak memory used per face while building the buffers of a chunk
+# of faces, including the intermediate corner arrays
+STREAM_BYTES_PER_FACE = 2048
+
+
+class SpillBuffer:
+    '''
+    Append-only binary buffer kept in a temporary file
+    '''
+
+    BLOCK_SIZE = 1 << 20
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.size = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def blocks(self):
+        '''
+        Yields the buffer contents in blocks of BLOCK_SIZE bytes
+        '''
+
+        self.file.flush()
+        self.file.seek(0)
+
+        while True:
+            block = self.file.read(self.BLOCK_SIZE)
+
+            if not block:
+                break
+
+            yield block
+
+    def close(self):
+        self.file.close()
+
+
+def stream_chunk_faces(memory_limit):
+    '''
+    memory_limit        int bytes
+
+    Returns the number of faces encoded at once for the given memory ceiling
+    '''
+
+    return max(memory_limit // STREAM_BYTES_PER_FACE, 4096)
+
+
+def encode_streamed(mesh_buffers, faces, precision='double', memory_limit=1 << 30):
+    '''
+    Collect the serialized mesh buffers of the given faces of a MeshBuffers,
+    a fixed number of faces at a time. The buffers of each chunk are spilled
+    to temporary files, so the memory used does not grow with the mesh size.
+    Vertices are only merged within a chunk, smooth vertices on the border
+    of two chunks are written twice.
+
+    Returns (flags, vertex count, triangle count, iterable of buffers),
+    the temporary files are removed once the buffers have been read.
+    '''
+
+    float_type = '<f4' if precision == 'single' else '<f8'
+    chunk_faces = stream_chunk_faces(memory_limit)
+
+    # create mesh flags
+    flags = 0
+    # turn on single or double precision
+    flags = flags | precision_flag(precision)
+    # turn on vertex normals
+    flags = flags | FLAG_VERTEX_NORMALS
+
+    # turn on uv layer
+    if mesh_buffers.uv is not None:
+        flags = flags | FLAG_TEXCOORDS
+
+    if mesh_buffers.color is not None:
+        flags = flags | FLAG_VERTEX_COLORS
+
+    points = SpillBuffer()
+    normals = SpillBuffer()
+    uvs = SpillBuffer()
+    vtx_colors = SpillBuffer()
+    face_vert_indices = SpillBuffer()
+    spills = [points, normals, uvs, vtx_colors, face_vert_indices]
+
+    vertex_count = 0
+    triangle_count = 0
+
+    for start in range(0, len(faces), chunk_faces):
+        submesh = mesh_buffers.submesh(faces[start:start + chunk_faces])
+
+        points.write(submesh.points.astype(float_type).tobytes())
+        normals.write(submesh.normals.astype(float_type).tobytes())
+
+        if submesh.uvs is not None:
+            uvs.write(submesh.uvs.astype(float_type).tobytes())
+
+        if submesh.colors is not None:
+            vtx_colors.write(submesh.colors.astype(float_type).tobytes())
+
+        face_vert_indices.write((submesh.indices + vertex_count).astype('<u4').tobytes())
+
+        vertex_count += submesh.vertex_count
+        triangle_count += submesh.triangle_count
+
+        del submesh
+
+    def read_spills():
+        try:
+            for spill in spills:
+                yield from spill.blocks()
 
-        # turn on uv layer
-        if uv_layer:
-            flags = flags | 0x0002
+        finally:
+            for spill in spills:
+                spill.close()
 
-        if vertex_color_layer:
-            flags = flags | 0x0008
+    return flags, vertex_count, triangle_count, read_spills()
+
+
+_compression_pool = None
+
+
+def get_compression_pool():
+    global _compression_pool
+
+    if _compression_pool is None:
+        try:
+            workers = multiprocessing.cpu_count()
+
+        except NotImplementedError:
+            workers = 1
+
+        _compression_pool = ThreadPoolExecutor(max_workers=workers)
+
+    return _compression_pool
+
+
+def _deflate_chunk(parts, level, zdict, last):
+    # Raw deflate of one chunk, primed with the end of the previous chunk.
+    # Non-final chunks end with a sync flush, so they are byte aligned and
+    # can be concatenated into a single deflate stream.
+    if zdict:
+        encoder = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, 9, zlib.Z_DEFAULT_STRATEGY, zdict)
+
+    else:
+        encoder = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, 9)
+
+    out = [encoder.compress(p) for p in parts]
+    out.append(encoder.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH))
+
+    return b''.join(out)
+
+
+class MeshCompressor:
+    '''
+    Produces the zlib stream of a serialized mesh.
+
+    By default the data is fed to one compressobj, giving the same stream
+    as zlib.compress. In parallel mode the data is cut into chunks that
+    are deflated concurrently on the compression thread pool (zlib releases
+    the GIL while compressing), and stitched back into one zlib stream.
+    '''
+
+    WINDOW_SIZE = 1 << 15
+
+    # number of chunks queued for compression before waiting for results
+    MAX_PENDING = 16
+
+    def __init__(self, level=zlib.Z_DEFAULT_COMPRESSION, parallel=False, chunk_size=1 << 20):
+        self.level = level
+        self.parallel = parallel
+        self.chunk_size = max(chunk_size, self.WINDOW_SIZE)
+
+    def chunks(self, data):
+        '''
+        Cut a list of buffers into lists of memoryviews of chunk_size bytes
+        '''
+
+        chunk = []
+        chunk_len = 0
+
+        for buf in data:
+            view = memoryview(buf).cast('B')
+
+            while len(view) > 0:
+                take = min(self.chunk_size - chunk_len, len(view))
+                chunk.append(view[:take])
+                chunk_len += take
+                view = view[take:]
+
+                if chunk_len == self.chunk_size:
+                    yield chunk
+                    chunk = []
+                    chunk_len = 0
+
+        if chunk_len > 0 or not chunk:
+            yield chunk
+
+    def tail(self, chunk):
+        # last WINDOW_SIZE bytes of a chunk, used as dictionary for the next one
+        parts = []
+        size = 0
+
+        for p in reversed(chunk):
+            parts.insert(0, p[max(0, len(p) - (self.WINDOW_SIZE - size)):])
+            size += len(parts[0])
+
+            if size == self.WINDOW_SIZE:
+                break
+
+        return b''.join(parts)
+
+    def compress(self, data):
+        '''
+        data                iterable of bytes-like objects
+
+        Yields the pieces of a complete zlib stream of the concatenated data
+        '''
+
+        if not self.parallel:
+            encoder = zlib.compressobj(self.level)
+
+            for buf in data:
+                yield encoder.compress(buf)
+
+            yield encoder.flush()
+            return
+
+        level = 6 if self.level == zlib.Z_DEFAULT_COMPRESSION else self.level
+        # zlib header: deflate with 32K window, level hint, check bits
+        cmf = 0x78
+        flg = (0 if level < 2 else 1 if level < 6 else 2 if level == 6 else 3) << 6
+        flg |= 31 - ((cmf << 8) | flg) % 31
+        yield struct.pack('>BB', cmf, flg)
+
+        pool = get_compression_pool()
+        pending = collections.deque()
+        adler = 1
+        zdict = None
+
+        # chunks are read one ahead to know which one is the last, and at most
+        # MAX_PENDING of them are held in memory, so that data can be a generator
+        chunks = self.chunks(data)
+        chunk = next(chunks)
+
+        while chunk is not None:
+            next_chunk = next(chunks, None)
+
+            for p in chunk:
+                adler = zlib.adler32(p, adler)
+
+            pending.append(pool.submit(_deflate_chunk, chunk, level, zdict, next_chunk is None))
+            zdict = self.tail(chunk)
+            chunk = next_chunk
+
+            while len(pending) > self.MAX_PENDING:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+        yield struct.pack('>I', adler & 0xffffffff)
+
+
+class SerializedContainer:
+    '''
+    Serialized file holding one or more meshes. Every mesh is appended to
+    the file as soon as it is added, the dictionary of mesh offsets is
+    written when the container is closed. Meshes are referenced from the
+    scene by filename and their shapeIndex, in the order they were added.
+    '''
+
+    def __init__(self, ser_path, compressor=None):
+        self.path = ser_path
+        self.offsets = []
+        self.compressor = compressor if compressor is not None else MeshCompressor()
+        self.file = open(ser_path, 'wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def shape_count(self):
+        return len(self.offsets)
+
+    def add_encoded(self, mesh_name, flags, vertex_count, triangle_count, data):
+        ser = self.file
+        self.offsets.append(ser.tell())
 
         # begin serialized mesh data
-        ser.write(struct.pack('<HH', 0x041C, 0x0004))
+        ser.write(struct.pack('<HH', SERIALIZED_MAGIC, SERIALIZED_VERSION))
 
         # encode serialized mesh
-        encoder = zlib.compressobj()
-        ser.write(encoder.compress(struct.pack('<I', flags)))
-        ser.write(encoder.compress(bytes(mesh_name + "_serialized\0", 'latin-1')))
-        ser.write(encoder.compress(struct.pack('<QQ', vert_index, int(ntris / 3))))
-        ser.write(encoder.compress(points.tostring()))
-        ser.write(encoder.compress(normals.tostring()))
+        header = [
+            struct.pack('<I', flags),
+            bytes(mesh_name + "_serialized\0", 'latin-1'),
+            struct.pack('<QQ', vertex_count, triangle_count),
+        ]
+
+        for piece in self.compressor.compress(itertools.chain(header, data)):
+            ser.write(piece)
+
+        return len(self.offsets) - 1
+
+    def add_mesh(self, mesh_name, mesh, ffaces_mats, precision='double'):
+        return self.add_encoded(mesh_name, *encode_mesh(mesh, ffaces_mats, precision))
+
+    def add_submesh(self, mesh_name, submesh, precision='double'):
+        return self.add_encoded(mesh_name, *encode_submesh(submesh, precision))
+
+    def add_streamed(self, mesh_name, mesh_buffers, faces, precision='double', memory_limit=1 << 30):
+        return self.add_encoded(mesh_name, *encode_streamed(mesh_buffers, faces, precision, memory_limit))
+
+    def close(self):
+        if self.file is None:
+            return
+
+        # dictionary of mesh offsets, followed by the number of meshes
+        for offset in self.offsets:
+            self.file.write(struct.pack('<Q', offset))
+
+        self.file.write(struct.pack('<I', len(self.offsets)))
+        self.file.close()
+        self.file = None
+
+
+def write_serialized_mesh(ser_path, mesh_name, mesh, ffaces_mats, compressor=None, precision='double'):
+    with SerializedContainer(ser_path, compressor) as ser:
+        ser.add_mesh(mesh_name, mesh, ffaces_mats, precision)
 
-        if uv_layer:
-            ser.write(encoder.compress(uvs.tostring()))
 
-        if vertex_color_layer:
-            ser.write(encoder.compress(vtx_colors.tostring()))
+def write_serialized_submesh(ser_path, mesh_name, submesh, compressor=None, precision='double'):
+    with SerializedContainer(ser_path, compressor) as ser:
+        ser.add_submesh(mesh_name, submesh, precision)
 
-        ser.write(encoder.compress(face_vert_indices.tostring()))
-        ser.write(encoder.flush())
 
-        ser.write(struct.pack('<Q', 0))
-        ser.write(struct.pack('<I', 1))
-        ser.close()
+def write_serialized_streamed(ser_path, mesh_name, mesh_buffers, faces, compressor=None, precision='double', memory_limit=1 << 30):
+    with SerializedContainer(ser_path, compressor) as ser:
+        ser.add_streamed(mesh_name, mesh_buffers, faces, precision, memory_limit)
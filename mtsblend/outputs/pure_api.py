@@ -28,15 +28,13 @@ import numpy
 
 import bpy
 
-from bpy_extras.io_utils import axis_conversion
-
 from ..extensions_framework import util as efutil
 
 # Mitsuba libs
 from .. import MitsubaAddon
 
 from ..export import ExportContextBase
-from ..export import matrix_to_list
+from ..export import simplify_motion
 from ..properties import ExportedVolumes
 
 from ..outputs import MtsLog, MtsManager
@@ -271,27 +269,30 @@ if not 'PYMTS_AVAILABLE' in locals() and addon_prefs is not None:
 
                 return transform
 
-            def transform_matrix(self, matrix):
-                # Blender is Z up but Mitsuba is Y up, convert the matrix
-                global_matrix = axis_conversion(to_forward="-Z", to_up="Y").to_4x4()
-                l = matrix_to_list(global_matrix * matrix)
+            def transform_list(self, l):
+                # l is a converted matrix, as returned by matrix_to_list
                 mat = Matrix4x4(l)
                 transform = Transform(mat)
 
                 return transform
 
-            def animated_transform(self, motion):
+            def animated_transform_list(self, motion, simplify=True):
+                # motion holds (time, converted matrix list) pairs, bulk exports
+                # simplify the motions themselves with linear_motions
+                if simplify:
+                    motion = simplify_motion(motion)
+
                 if len(motion) == 2 and motion[0][1] == motion[1][1]:
                     del motion[1]
 
                 if len(motion) > 1:
                     transform = AnimatedTransform()
 
-                    for (t, m) in motion:
-                        transform.appendTransform(t, self.transform_matrix(m))
+                    for (t, l) in motion:
+                        transform.appendTransform(t, self.transform_list(l))
 
                 else:
-                    transform = self.transform_matrix(motion[0][1])
+                    transform = self.transform_list(motion[0][1])
 
                 return transform
 
@@ -503,17 +504,29 @@ if not 'PYMTS_AVAILABLE' in locals() and addon_prefs is not None:
             def wait_timer(self):
                 pass
 
-        class Serializer:
+        class SerializedStream:
             '''
-            Helper Class for fast mesh export in File API
+            Serialized file holding one or more meshes written by the
+            python extension. The dictionary of mesh offsets is written
+            when the stream is closed.
             '''
 
-            def __init__(self):
-                self.thread = Thread.registerUnmanagedThread('serializer')
-                self.thread.setFileResolver(main_fresolver)
-                self.thread.setLogger(main_logger)
+            def __init__(self, fileName):
+                self.path = fileName
+                self.offsets = []
+                self.fstream = FileStream(fileName, FileStream.ETruncReadWrite)
 
-            def serialize(self, fileName, name, mesh, materialID):
+            def __enter__(self):
+                return self
+
+            def __exit__(self, exc_type, exc_val, exc_tb):
+                self.close()
+
+            @property
+            def shape_count(self):
+                return len(self.offsets)
+
+            def add_mesh(self, name, mesh, materialID):
                 faces = mesh.tessfaces[0].as_pointer()
                 vertices = mesh.vertices[0].as_pointer()
 
@@ -536,11 +549,41 @@ if not 'PYMTS_AVAILABLE' in locals() and addon_prefs is not None:
                 trimesh = TriMesh.fromBlender(mesh.name, len(mesh.tessfaces),
                     faces, len(mesh.vertices), vertices, texCoords, vertexColors, materialID)
 
-                fstream = FileStream(fileName, FileStream.ETruncReadWrite)
-                trimesh.serialize(fstream)
-                fstream.writeULong(0)
-                fstream.writeUInt(1)
-                fstream.close()
+                self.offsets.append(self.fstream.getPos())
+                trimesh.serialize(self.fstream)
+
+                return len(self.offsets) - 1
+
+            def close(self):
+                if self.fstream is None:
+                    return
+
+                for offset in self.offsets:
+                    self.fstream.writeULong(offset)
+
+                self.fstream.writeUInt(len(self.offsets))
+                self.fstream.close()
+                self.fstream = None
+
+        class Serializer:
+            '''
+            Helper Class for fast mesh export in File API
+            '''
+
+            # TriMesh is serialized with the floating point precision Mitsuba was built with
+            precision = 'double' if Vector(1.0 / 3.0, 0, 0).x == 1.0 / 3.0 else 'single'
+
+            def __init__(self):
+                self.thread = Thread.registerUnmanagedThread('serializer')
+                self.thread.setFileResolver(main_fresolver)
+                self.thread.setLogger(main_logger)
+
+            def open(self, fileName):
+                return SerializedStream(fileName)
+
+            def serialize(self, fileName, name, mesh, materialID):
+                with SerializedStream(fileName) as stream:
+                    stream.add_mesh(name, mesh, materialID)
 
         PYMTS_AVAILABLE = True
         MtsLog('Using Mitsuba python extension')
@@ -76,7 +76,18 @@ class mitsuba_engine(declarative_property_group):
         #'write_files',
         ['export_particles', 'export_hair'],
         'mesh_type',
+        'mesh_writer',
+        'background_writing',
+        'serialized_container',
+        'mesh_precision',
+        ['compression_level', 'parallel_compression'],
+        'mesh_memory_limit',
+        'deformation_topology',
+        'auto_instancing',
+        'static_geometry',
+        'export_cache_limit',
         'partial_export',
+        'mesh_cache_path',
         'render',
         'refresh_interval',
         'threads_auto',
@@ -87,6 +98,18 @@ class mitsuba_engine(declarative_property_group):
     visibility = {
         'write_files': {'export_type': 'INT'},
         'mesh_type': O([{'export_type':'EXT'}, A([{'export_type':'INT'}, {'write_files': True}])]),
+        'mesh_writer': O([{'export_type':'EXT'}, A([{'export_type':'INT'}, {'write_files': True}])]),
+        'background_writing': A([{'mesh_writer': 'numpy'}, O([{'export_type':'EXT'}, A([{'export_type':'INT'}, {'write_files': True}])])]),
+        'mesh_precision': A([{'mesh_type': 'serialized'}, O([{'export_type':'EXT'}, A([{'export_type':'INT'}, {'write_files': True}])])]),
+        'compression_level': A([{'mesh_type': 'serialized'}, O([{'export_type':'EXT'}, A([{'export_type':'INT'}, {'write_files': True}])])]),
+        'parallel_compression': A([{'mesh_type': 'serialized'}, O([{'export_type':'EXT'}, A([{'export_type':'INT'}, {'write_files': True}])])]),
+        'serialized_container': A([{'mesh_type': 'serialized'}, O([{'export_type':'EXT'}, A([{'export_type':'INT'}, {'write_files': True}])])]),
+        'mesh_memory_limit': A([{'mesh_type': 'serialized'}, O([{'export_type':'EXT'}, A([{'export_type':'INT'}, {'write_files': True}])])]),
+        'export_cache_limit': O([{'export_type':'EXT'}, A([{'export_type':'INT'}, {'write_files': True}])]),
+        'deformation_topology': A([{'mesh_writer': 'numpy'}, O([{'export_type':'EXT'}, A([{'export_type':'INT'}, {'write_files': True}])])]),
+        'static_geometry': A([{'partial_export': False}, O([{'export_type':'EXT'}, A([{'export_type':'INT'}, {'write_files': True}])])]),
+        'auto_instancing': O([{'export_type':'EXT'}, A([{'export_type':'INT'}, {'write_files': True}])]),
+        'mesh_cache_path': {'partial_export': True},
         'binary_name': {'export_type': 'EXT'},
         'render': O([{'write_files': True}, {'export_type': 'EXT'}]),  # We need run renderer unless we are set for internal-pipe mode, which is the only time both of these are false
         'threads': {'threads_auto': False},
@@ -130,11 +153,44 @@ class mitsuba_engine(declarative_property_group):
         {
             'type': 'bool',
             'attr': 'partial_export',
-            'name': 'Partial Mesh Export',
-            'description': 'Skip exporting Mesh files that already exist. Try disabling this if you have geometry issues',
+            'name': 'Mesh Cache',
+            'description': 'Write each distinct mesh only once into a persistent cache and reuse it across objects, frames and exports',
             'default': False,
             'save_in_preset': True
         },
+        {
+            'type': 'bool',
+            'attr': 'deformation_topology',
+            'name': 'Shared Deformation Topology',
+            'description': 'Build the triangles, UVs and colors of deforming meshes once per frame, motion blur time samples only read the new vertex positions and normals',
+            'default': True,
+            'save_in_preset': True
+        },
+        {
+            'type': 'bool',
+            'attr': 'static_geometry',
+            'name': 'Share Static Meshes',
+            'description': 'Write meshes that do not deform into a static folder shared by all frames, instead of the folder of each frame. Files are named after their contents, so changed meshes are written again',
+            'default': False,
+            'save_in_preset': True
+        },
+        {
+            'type': 'bool',
+            'attr': 'auto_instancing',
+            'name': 'Instance Identical Meshes',
+            'description': 'Export identical static meshes of different mesh datablocks once, as instances of a shared shape group',
+            'default': False,
+            'save_in_preset': True
+        },
+        {
+            'type': 'string',
+            'subtype': 'DIR_PATH',
+            'attr': 'mesh_cache_path',
+            'name': 'Cache Path',
+            'description': 'Folder of the mesh cache, leave empty to use the mesh_cache folder of the export path',
+            'default': '',
+            'save_in_preset': True
+        },
         {
             'type': 'enum',
             'attr': 'binary_name',
@@ -181,6 +237,90 @@ class mitsuba_engine(declarative_property_group):
             'default': 'serialized',
             'save_in_preset': True
         },
+        {
+            'type': 'enum',
+            'attr': 'mesh_writer',
+            'name': 'Mesh Writer',
+            'description': 'Mesh file writer. Serialized meshes are written by the Mitsuba python extension when it is available',
+            'items': [
+                ('numpy', 'NumPy', 'Read mesh data in bulk and process it with NumPy arrays'),
+                ('python', 'Python', 'Process mesh data face by face in python'),
+            ],
+            'default': 'numpy',
+            'save_in_preset': True
+        },
+        {
+            'type': 'bool',
+            'attr': 'background_writing',
+            'name': 'Background Mesh Writing',
+            'description': 'Encode, compress and write mesh files on worker threads while the rest of the scene is exported',
+            'default': True,
+            'save_in_preset': True
+        },
+        {
+            'type': 'enum',
+            'attr': 'serialized_container',
+            'name': 'Mesh Files',
+            'description': 'Write several serialized meshes into one file, referenced by shape index. The mesh cache only applies to separate files',
+            'items': [
+                ('none', 'One file per mesh', 'none'),
+                ('object', 'One file per object', 'object'),
+                ('frame', 'One file per frame', 'frame'),
+            ],
+            'default': 'none',
+            'save_in_preset': True
+        },
+        {
+            'type': 'enum',
+            'attr': 'mesh_precision',
+            'name': 'Mesh Precision',
+            'description': 'Floating point precision of serialized mesh data. Single precision halves file size and loading time',
+            'items': [
+                ('auto', 'Automatic', 'Precision of the Mitsuba python extension, so that it writes the meshes, double without it'),
+                ('single', 'Single (32 bit)', 'single'),
+                ('double', 'Double (64 bit)', 'double'),
+            ],
+            'default': 'auto',
+            'save_in_preset': True
+        },
+        {
+            'type': 'int',
+            'attr': 'compression_level',
+            'name': 'Compression',
+            'description': 'zlib compression level of serialized meshes written by the addon. 1 is fastest, 9 gives the smallest files',
+            'default': 6,
+            'min': 1,
+            'max': 9,
+            'save_in_preset': True
+        },
+        {
+            'type': 'bool',
+            'attr': 'parallel_compression',
+            'name': 'Parallel Compression',
+            'description': 'Compress serialized meshes in chunks on all CPU cores',
+            'default': True,
+            'save_in_preset': True
+        },
+        {
+            'type': 'int',
+            'attr': 'mesh_memory_limit',
+            'name': 'Mesh Memory Limit (MB)',
+            'description': 'Encode serialized meshes needing more memory than this in chunks of faces, spilled to temporary files. 0 disables the limit',
+            'default': 2048,
+            'min': 0,
+            'soft_max': 65536,
+            'save_in_preset': True
+        },
+        {
+            'type': 'int',
+            'attr': 'export_cache_limit',
+            'name': 'Export Cache Limit (MB)',
+            'description': 'Memory budget of the cache of exported meshes, least recently used meshes are dropped and exported again when needed. 0 disables the limit',
+            'default': 0,
+            'min': 0,
+            'soft_max': 4096,
+            'save_in_preset': True
+        },
         {
             'type': 'enum',
             'attr': 'log_verbosity',
@@ -32,6 +32,7 @@ class mitsuba_mesh(declarative_property_group):
 
     controls = [
         'mesh_type',
+        'precision',
         'normals'
     ]
 
@@ -50,6 +51,18 @@ class mitsuba_mesh(declarative_property_group):
             ],
             'default': 'global'
         },
+        {
+            'type': 'enum',
+            'attr': 'precision',
+            'name': 'Precision',
+            'description': 'Floating point precision of serialized mesh data',
+            'items': [
+                ('global', 'Use default setting', 'global'),
+                ('single', 'Single (32 bit)', 'single'),
+                ('double', 'Double (64 bit)', 'double')
+            ],
+            'default': 'global'
+        },
         {
             'type': 'enum',
             'attr': 'normals',
@@ -36,6 +36,7 @@ class mitsuba_hair(declarative_property_group):
 
     controls = [
         'hair_width',
+        'hair_format',
     ]
 
     properties = [
@@ -51,4 +52,15 @@ class mitsuba_hair(declarative_property_group):
             'sub_type': 'DISTANCE',
             'unit': 'LENGTH',
         },
+        {
+            'type': 'enum',
+            'attr': 'hair_format',
+            'name': 'Hair File',
+            'description': 'Format of the exported hair file',
+            'items': [
+                ('binary', 'Binary', 'Single precision points, compact and fast to write and load'),
+                ('ascii', 'ASCII', 'One point per text line'),
+            ],
+            'default': 'binary',
+        },
     ]